@@ -0,0 +1,90 @@
+-- INBOX CHAT: una riga per (utente, thread) con ultimo messaggio e non letti.
+-- Mantenuta da post_message() tramite la funzione chat_inbox_bump (atomica:
+-- il contatore dei non letti viene incrementato lato database, senza race).
+
+-- 1. TABELLA RIEPILOGO
+CREATE TABLE IF NOT EXISTS chat_inbox (
+    user_id TEXT NOT NULL,
+    thread_id TEXT NOT NULL,
+    counterpart_id TEXT,
+    counterpart_name TEXT,
+    last_message TEXT,
+    last_sender_id TEXT,
+    last_message_at TIMESTAMPTZ,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, thread_id)
+);
+
+CREATE INDEX IF NOT EXISTS chat_inbox_user_last_idx
+    ON chat_inbox (user_id, last_message_at DESC);
+
+-- Il backend usa la chiave service_role (come per profiles)
+ALTER TABLE chat_inbox DISABLE ROW LEVEL SECURITY;
+
+-- 2. AGGIORNAMENTO AD OGNI MESSAGGIO
+-- La versione precedente (senza p_receiver_name) va rimossa: con il nuovo parametro
+-- opzionale PostgREST non saprebbe quale delle due chiamare.
+DROP FUNCTION IF EXISTS chat_inbox_bump(TEXT, TEXT, TEXT, TEXT, TEXT, TIMESTAMPTZ);
+
+CREATE OR REPLACE FUNCTION chat_inbox_bump(
+    p_thread_id TEXT,
+    p_sender_id TEXT,
+    p_sender_name TEXT,
+    p_receiver_id TEXT,
+    p_text TEXT,
+    p_created_at TIMESTAMPTZ,
+    p_receiver_name TEXT DEFAULT NULL
+) RETURNS void LANGUAGE sql AS $$
+    -- Mittente: aggiorna l'anteprima, i suoi non letti restano invariati.
+    -- Nome della controparte (il destinatario): dal client o, se manca, da profiles
+    INSERT INTO chat_inbox (user_id, thread_id, counterpart_id, counterpart_name, last_message, last_sender_id, last_message_at, unread_count)
+    VALUES (
+        p_sender_id, p_thread_id, p_receiver_id,
+        COALESCE(p_receiver_name, (SELECT name FROM profiles WHERE id = p_receiver_id)),
+        p_text, p_sender_id, p_created_at, 0
+    )
+    ON CONFLICT (user_id, thread_id) DO UPDATE SET
+        counterpart_id = EXCLUDED.counterpart_id,
+        counterpart_name = COALESCE(EXCLUDED.counterpart_name, chat_inbox.counterpart_name),
+        last_message = EXCLUDED.last_message,
+        last_sender_id = EXCLUDED.last_sender_id,
+        last_message_at = EXCLUDED.last_message_at;
+
+    -- Destinatario: anteprima + un non letto in più
+    INSERT INTO chat_inbox (user_id, thread_id, counterpart_id, counterpart_name, last_message, last_sender_id, last_message_at, unread_count)
+    VALUES (
+        p_receiver_id, p_thread_id, p_sender_id,
+        COALESCE(p_sender_name, (SELECT name FROM profiles WHERE id = p_sender_id)),
+        p_text, p_sender_id, p_created_at, 1
+    )
+    ON CONFLICT (user_id, thread_id) DO UPDATE SET
+        counterpart_id = EXCLUDED.counterpart_id,
+        counterpart_name = COALESCE(EXCLUDED.counterpart_name, chat_inbox.counterpart_name),
+        last_message = EXCLUDED.last_message,
+        last_sender_id = EXCLUDED.last_sender_id,
+        last_message_at = EXCLUDED.last_message_at,
+        unread_count = chat_inbox.unread_count + 1;
+$$;
+
+-- 3. POPOLAMENTO INIZIALE dai messaggi esistenti (una volta sola, non letti = 0)
+INSERT INTO chat_inbox (user_id, thread_id, counterpart_id, counterpart_name, last_message, last_sender_id, last_message_at)
+SELECT DISTINCT ON (u.user_id, m.thread_id)
+    u.user_id,
+    m.thread_id,
+    CASE WHEN u.user_id = m.sender_id THEN m.receiver_id ELSE m.sender_id END,
+    CASE WHEN u.user_id = m.sender_id
+        THEN (SELECT p.name FROM profiles p WHERE p.id = m.receiver_id)
+        ELSE COALESCE(m.sender_name, (SELECT p.name FROM profiles p WHERE p.id = m.sender_id))
+    END,
+    m.text,
+    m.sender_id,
+    m.created_at
+FROM chat_messages m
+CROSS JOIN LATERAL (VALUES (m.sender_id), (m.receiver_id)) AS u(user_id)
+ORDER BY u.user_id, m.thread_id, m.created_at DESC
+ON CONFLICT (user_id, thread_id) DO NOTHING;
+
+-- 4. NOMI MANCANTI nelle righe già esistenti (lato mittente erano sempre NULL)
+UPDATE chat_inbox i SET counterpart_name = p.name
+FROM profiles p
+WHERE i.counterpart_name IS NULL AND p.id = i.counterpart_id AND p.name IS NOT NULL;
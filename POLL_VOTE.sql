@@ -0,0 +1,52 @@
+-- VOTO SONDAGGI ATOMICO: usato da vote_poll() in server.py.
+-- Lettura e scrittura di 'choices' e 'voters' avvengono nella stessa transazione
+-- con lock della riga: con più worker gunicorn nessun voto concorrente va perso.
+-- Senza questa funzione il backend ripiega su un compare-and-swap di 'choices'.
+-- Assume 'choices' e 'voters' di tipo JSONB.
+
+CREATE OR REPLACE FUNCTION poll_vote(
+    p_poll_id polls.id%TYPE,
+    p_voter TEXT,
+    p_choice TEXT
+) RETURNS JSONB LANGUAGE plpgsql AS $$
+DECLARE
+    v_poll polls%ROWTYPE;
+    v_prev TEXT;
+BEGIN
+    SELECT * INTO v_poll FROM polls WHERE id = p_poll_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+
+    v_prev := COALESCE(v_poll.voters, '{}'::jsonb) ->> p_voter;
+    IF v_prev IS DISTINCT FROM p_choice THEN
+        -- +1 alla scelta nuova, -1 (minimo 0) alla precedente, ordine delle opzioni invariato
+        UPDATE polls SET
+            choices = (
+                SELECT COALESCE(jsonb_agg(
+                    CASE
+                        WHEN c->>'id' = p_choice
+                            THEN jsonb_set(c, '{votes}', to_jsonb(COALESCE((c->>'votes')::int, 0) + 1))
+                        WHEN c->>'id' = v_prev
+                            THEN jsonb_set(c, '{votes}', to_jsonb(GREATEST(COALESCE((c->>'votes')::int, 0) - 1, 0)))
+                        ELSE c
+                    END ORDER BY t.ord), '[]'::jsonb)
+                FROM jsonb_array_elements(COALESCE(v_poll.choices, '[]'::jsonb)) WITH ORDINALITY AS t(c, ord)
+            ),
+            voters = COALESCE(v_poll.voters, '{}'::jsonb) || jsonb_build_object(p_voter, p_choice)
+        WHERE id = p_poll_id
+        RETURNING * INTO v_poll;
+    END IF;
+
+    -- Niente mappa 'voters' nella risposta: solo la scelta precedente del votante
+    RETURN jsonb_build_object(
+        'id', v_poll.id,
+        'question', v_poll.question,
+        'choices', v_poll.choices,
+        'author', v_poll.author,
+        'created_at', v_poll.created_at,
+        'expires_at', v_poll.expires_at,
+        'previous', v_prev
+    );
+END;
+$$;
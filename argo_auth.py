@@ -0,0 +1,128 @@
+import os
+import re
+import base64
+import secrets
+from contextlib import contextmanager
+from hashlib import sha256
+
+import requests
+
+from timing import StageTimer
+
+# Flusso OAuth (PKCE) dell'app Argo DidUP famiglia, condiviso da server.py e debug_auth.py.
+# Fasi cronometrate: challenge, sso, redirect-N, token, argo-login.
+CHALLENGE_URL = "https://auth.portaleargo.it/oauth2/auth"
+LOGIN_URL = "https://www.portaleargo.it/auth/sso/login"
+TOKEN_URL = "https://auth.portaleargo.it/oauth2/token"
+REDIRECT_URI = "it.argosoft.didup.famiglia.new://login-callback"
+CLIENT_ID = "72fd6dea-d0ab-4bb9-8eaa-3ac24c84886c"
+ENDPOINT = "https://www.portaleargo.it/appfamiglia/api/rest/"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/106.0.0.0 Safari/537.36"
+
+MAX_REDIRECTS = 10
+# Prefisso delle fasi nelle metriche (db.stats(), /health?verbose=1)
+METRIC_PREFIX = "argo-auth"
+# (connessione, lettura) per ogni chiamata: senza, un server Argo bloccato
+# terrebbe occupato il thread del worker fino al timeout di gunicorn
+ARGO_CONNECT_TIMEOUT = float(os.getenv("ARGO_CONNECT_TIMEOUT", "5"))
+ARGO_READ_TIMEOUT = float(os.getenv("ARGO_READ_TIMEOUT", "20"))
+ARGO_TIMEOUT = (ARGO_CONNECT_TIMEOUT, ARGO_READ_TIMEOUT)
+
+
+@contextmanager
+def _stage(timer, name):
+    """Fase cronometrata (fallita se solleva); un timeout riporta il nome della fase."""
+    with timer.stage(name, METRIC_PREFIX):
+        try:
+            yield
+        except requests.Timeout as e:
+            raise requests.Timeout(f"Timeout Argo nella fase '{name}'") from e
+
+
+def oauth_login(school, username, password, timer=None):
+    """
+    Login completo: ritorna (access_token, soggetti) dove 'soggetti' è la lista
+    dei profili restituita da Argo /login. Solleva eccezione se una fase fallisce.
+    """
+    timer = timer or StageTimer()
+    code_verifier = secrets.token_hex(64)
+    code_challenge = base64.urlsafe_b64encode(
+        sha256(code_verifier.encode()).digest()
+    ).decode().replace("=", "")
+    session = requests.Session()
+
+    with _stage(timer, "challenge"):
+        params = {
+            "redirect_uri": REDIRECT_URI,
+            "client_id": CLIENT_ID,
+            "response_type": "code",
+            "prompt": "login",
+            "state": secrets.token_urlsafe(32),
+            "scope": "openid offline profile user.roles argo",
+            "code_challenge": code_challenge,
+            "code_challenge_method": "S256"
+        }
+        req = session.get(CHALLENGE_URL, params=params, timeout=ARGO_TIMEOUT)
+        m = re.search(r"login_challenge=([0-9a-f]+)", req.url)
+        if not m:
+            raise Exception("Login challenge non trovata")
+        login_challenge = m.group(1)
+
+    with _stage(timer, "sso"):
+        login_data = {
+            "challenge": login_challenge,
+            "client_id": CLIENT_ID,
+            "prefill": "true",
+            "famiglia_customer_code": school,
+            "username": username,
+            "password": password,
+            "login": "true"
+        }
+        req = session.post(LOGIN_URL, data=login_data, allow_redirects=False, timeout=ARGO_TIMEOUT)
+        if "Location" not in req.headers:
+            raise ValueError("Credenziali errate o scuola non valida")
+
+    location = req.headers["Location"]
+    hop = 0
+    while "code=" not in location:
+        hop += 1
+        if hop > MAX_REDIRECTS:
+            raise Exception("Troppi redirect nel login Argo")
+        with _stage(timer, f"redirect-{hop}"):
+            req = session.get(location, allow_redirects=False, timeout=ARGO_TIMEOUT)
+            location = req.headers["Location"]
+
+    code_match = re.search(r"code=([0-9a-zA-Z-_.]+)", location)
+    if not code_match:
+        raise Exception("Auth code non trovato")
+    code = code_match.group(1)
+
+    with _stage(timer, "token"):
+        token_req_data = {
+            "code": code,
+            "grant_type": "authorization_code",
+            "redirect_uri": REDIRECT_URI,
+            "code_verifier": code_verifier,
+            "client_id": CLIENT_ID
+        }
+        tokens = session.post(TOKEN_URL, data=token_req_data, timeout=ARGO_TIMEOUT).json()
+        access_token = tokens["access_token"]
+
+    with _stage(timer, "argo-login"):
+        login_headers = {
+            "User-Agent": USER_AGENT,
+            "Content-Type": "application/json",
+            "Authorization": "Bearer " + access_token,
+            "Accept": "application/json",
+        }
+        payload = {
+            "clientID": secrets.token_urlsafe(64),
+            "lista-x-auth-token": "[]",
+            "x-auth-token-corrente": "null",
+            "lista-opzioni-notifiche": "{}"
+        }
+        argo_resp = requests.post(ENDPOINT + "login", headers=login_headers, json=payload,
+                                  timeout=ARGO_TIMEOUT).json()
+        soggetti = argo_resp.get("data", []) or []
+
+    return access_token, soggetti
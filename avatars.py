@@ -0,0 +1,186 @@
+import io
+import os
+import hashlib
+import tempfile
+import requests
+
+from db import session
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # senza Pillow si salva solo l'originale
+    Image = None
+
+AVATAR_BUCKET = "avatars"
+AVATAR_MAX_BYTES = int(os.environ.get("AVATAR_MAX_BYTES", str(5 * 1024 * 1024)))
+# Sopra questa soglia il buffer dell'upload passa dalla RAM a un file temporaneo
+SPOOL_MEMORY_BYTES = 256 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# Solo formati raster: niente SVG (script inline) né tipi arbitrari
+AVATAR_TYPES = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/jpg": "jpg",
+    "image/webp": "webp",
+    "image/gif": "gif",
+    "image/heic": "heic",
+}
+
+
+# Lati (px) delle varianti quadrate generate a ogni upload
+AVATAR_VARIANT_SIZES = (64, 128, 512)
+# Variante usata come 'url' principale (cerchi di feed e chat)
+AVATAR_DEFAULT_VARIANT = 128
+VARIANT_FORMAT = ("WEBP", "image/webp", "webp")
+VARIANT_QUALITY = 80
+# Nomi content-addressed: il contenuto di un oggetto non cambia mai, quindi
+# browser e CDN possono tenerlo in cache per sempre
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def spool_stream(stream, max_bytes=AVATAR_MAX_BYTES, chunk_size=CHUNK_SIZE):
+    """
+    Copia uno stream in un file temporaneo a blocchi, interrompendo appena si
+    supera max_bytes. Ritorna (file posizionato all'inizio, dimensione).
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+    size = 0
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"Immagine troppo grande (max {max_bytes // 1024} KB)")
+            spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, size
+
+
+def file_size(fileobj):
+    """Dimensione di un file già bufferizzato, lasciandolo posizionato all'inizio."""
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    return size
+
+
+def content_hash(fileobj, chunk_size=CHUNK_SIZE):
+    """SHA-256 del contenuto (letto a blocchi), lasciando il file all'inizio."""
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def storage_object_url(path, bucket=AVATAR_BUCKET):
+    return f"{os.getenv('SUPABASE_URL')}/storage/v1/object/{bucket}/{path}"
+
+
+def public_url(path, bucket=AVATAR_BUCKET):
+    return f"{os.getenv('SUPABASE_URL')}/storage/v1/object/public/{bucket}/{path}"
+
+
+def object_exists(path, bucket=AVATAR_BUCKET, timeout=10):
+    """HEAD sull'URL pubblico: True se l'oggetto è già presente."""
+    try:
+        return session.head(public_url(path, bucket), timeout=timeout).status_code == 200
+    except requests.RequestException:
+        return False
+
+
+def upload_object(path, fileobj, content_type, size, bucket=AVATAR_BUCKET, upsert=False,
+                  cache_control=IMMUTABLE_CACHE_CONTROL, timeout=30):
+    """
+    Carica un oggetto su Supabase Storage inviando il file a blocchi
+    (requests legge il file object in streaming, senza copiarlo in memoria).
+    Senza upsert, un oggetto già esistente con lo stesso nome non è un errore:
+    con nomi content-addressed il contenuto è per forza identico.
+    """
+    key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    headers = {
+        "apikey": key,
+        "Authorization": f"Bearer {key}",
+        "Content-Type": content_type,
+        "Content-Length": str(size),
+        "cache-control": cache_control,
+        "x-upsert": "true" if upsert else "false",
+    }
+    r = session.post(storage_object_url(path, bucket), headers=headers, data=fileobj, timeout=timeout)
+    if not r.ok and not (r.status_code in (400, 409) and "Duplicate" in r.text):
+        raise RuntimeError(f"Storage upload failed ({r.status_code}): {r.text[:200]}")
+    return public_url(path, bucket)
+
+
+def make_variants(fileobj, sizes=AVATAR_VARIANT_SIZES):
+    """
+    Genera le varianti quadrate (ritaglio centrale) in WebP.
+    Solo riduzioni: i lati più grandi del lato corto della sorgente vengono
+    saltati (ingrandire aumenta i byte e sfoca), quindi si usa l'originale.
+    Ritorna {lato: bytes}; dict vuoto se Pillow manca o l'immagine non è decodificabile.
+    """
+    if Image is None:
+        return {}
+    try:
+        fileobj.seek(0)
+        with Image.open(fileobj) as img:
+            largest = max(sizes)
+            # JPEG: decodifica direttamente a scala ridotta (molta meno RAM e CPU)
+            img.draft("RGB", (largest * 2, largest * 2))
+            img = ImageOps.exif_transpose(img)
+            img = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P") else "RGB")
+            side = min(img.size)
+            square = ImageOps.fit(img, (min(side, largest), min(side, largest)), Image.LANCZOS)
+        variants = {}
+        for size in sorted(sizes, reverse=True):
+            if size > square.width:
+                continue
+            out = io.BytesIO()
+            resized = square if size == square.width else square.resize((size, size), Image.LANCZOS)
+            resized.save(out, VARIANT_FORMAT[0], quality=VARIANT_QUALITY, method=4)
+            variants[size] = out.getvalue()
+        return variants
+    except Exception:
+        return {}
+    finally:
+        fileobj.seek(0)
+
+
+def variant_path(base_name, side):
+    return f"{base_name}_{side}.{VARIANT_FORMAT[2]}"
+
+
+def upload_variants(base_name, fileobj, sizes=AVATAR_VARIANT_SIZES):
+    """Genera e carica le varianti. Ritorna {'lato': url} delle sole varianti scritte."""
+    variants = {}
+    for side, data in make_variants(fileobj, sizes).items():
+        variants[str(side)] = upload_object(
+            variant_path(base_name, side), io.BytesIO(data), VARIANT_FORMAT[1], len(data)
+        )
+    return variants
+
+
+def stored_variants(base_name, sizes=AVATAR_VARIANT_SIZES):
+    """
+    Varianti già presenti su Storage, {'lato': url}.
+    make_variants salta solo i lati sopra una soglia, quindi si controlla in
+    ordine crescente e ci si ferma al primo lato mancante.
+    """
+    variants = {}
+    for side in sorted(sizes):
+        path = variant_path(base_name, side)
+        if not object_exists(path):
+            break
+        variants[str(side)] = public_url(path)
+    return variants
@@ -0,0 +1,107 @@
+import os
+import hmac
+from hashlib import sha256
+from datetime import date, datetime, timedelta, timezone
+
+from cache import TTLCache
+
+# Feed iCalendar dei compiti, uno per profilo.
+# L'URL contiene un token HMAC del profilo: non si può indovinare né risalire
+# all'utente, e il feed si legge dallo snapshot senza chiamate ad Argo.
+CALENDAR_NAME = "Compiti G-Connect"
+CALENDAR_REFRESH = "PT1H"  # intervallo di aggiornamento suggerito ai client calendario
+TOKEN_LENGTH = 32
+
+# ICS già generati, per hash dell'insieme dei compiti
+ics_cache = TTLCache(maxsize=2000, ttl=24 * 3600)
+
+
+def calendar_secret():
+    # letto a ogni uso, non all'import: il .env può essere caricato dopo
+    return os.getenv("CALENDAR_SECRET") or os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+
+
+def calendar_token(pid):
+    """Token del feed per un profilo ('school:user:index'), None se manca il segreto."""
+    secret = calendar_secret()
+    if not secret:
+        return None
+    return hmac.new(secret.encode(), f"ics:{pid}".encode(), sha256).hexdigest()[:TOKEN_LENGTH]
+
+
+def is_valid_token(token):
+    return len(token) == TOKEN_LENGTH and all(c in "0123456789abcdef" for c in token)
+
+
+def ics_escape(text):
+    return (str(text or "").replace("\\", "\\\\").replace(";", "\\;")
+            .replace(",", "\\,").replace("\r\n", "\\n").replace("\n", "\\n"))
+
+
+def fold(line):
+    """Righe ICS al massimo di 75 byte (RFC 5545 §3.1), continuazione con uno spazio."""
+    raw = line.encode("utf-8")
+    if len(raw) <= 75:
+        return line
+    parts, current = [], b""
+    for ch in line:
+        b = ch.encode("utf-8")
+        if len(current) + len(b) > (75 if not parts else 74):
+            parts.append(current.decode("utf-8"))
+            current = b""
+        current += b
+    parts.append(current.decode("utf-8"))
+    return "\r\n ".join(parts)
+
+
+def parse_due(value):
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except (TypeError, ValueError):
+        return None
+
+
+def render_ics(tasks, stamp=None):
+    """Compiti (schema /sync: id, text, subject, due_date) -> calendario con eventi di un giorno."""
+    stamp = (stamp or datetime.now(timezone.utc)).astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//G-Connect//Compiti//IT",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{ics_escape(CALENDAR_NAME)}",
+        f"REFRESH-INTERVAL;VALUE=DURATION:{CALENDAR_REFRESH}",
+        f"X-PUBLISHED-TTL:{CALENDAR_REFRESH}",
+    ]
+    for t in tasks or []:
+        due = parse_due(t.get("due_date") or t.get("datCompito"))
+        if not due:
+            continue
+        subject = t.get("subject") or t.get("materia") or "Compiti"
+        text = t.get("text") or ""
+        summary = f"{subject}: {text}"
+        if len(summary) > 80:
+            summary = summary[:77] + "..."
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{t.get('id') or sha256(summary.encode()).hexdigest()[:12]}@g-connect",
+            f"DTSTAMP:{stamp}",
+            f"DTSTART;VALUE=DATE:{due.strftime('%Y%m%d')}",
+            f"DTEND;VALUE=DATE:{(due + timedelta(days=1)).strftime('%Y%m%d')}",
+            f"SUMMARY:{ics_escape(summary)}",
+            f"DESCRIPTION:{ics_escape(text)}",
+            "TRANSP:TRANSPARENT",
+            "END:VEVENT",
+        ]
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(fold(l) for l in lines) + "\r\n").encode("utf-8")
+
+
+def cached_ics(content_hash, tasks, stamp=None):
+    """render_ics in cache per hash: si rigenera solo quando cambiano i compiti."""
+    body = ics_cache.get(content_hash)
+    if body is None:
+        body = render_ics(tasks, stamp)
+        ics_cache.set(content_hash, body)
+    return body
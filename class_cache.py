@@ -0,0 +1,46 @@
+import os
+
+from cache import TTLCache
+
+# Compiti e avvisi sono uguali per tutta la classe: il primo studente che
+# sincronizza li analizza, gli altri riusano gli stessi oggetti.
+CLASS_CACHE_SIZE = int(os.getenv("CLASS_CACHE_SIZE", "20000"))
+CLASS_CACHE_TTL = int(os.getenv("CLASS_CACHE_TTL", "1800"))
+
+
+def class_scope(school, cls):
+    """Chiave 'codMin:classe', o None se la classe non è nota (niente condivisione)."""
+    school = (school or "").strip().upper()
+    cls = (cls or "").strip().upper()
+    if not school or not cls or cls == "N/D":
+        return None
+    return f"{school}:{cls}"
+
+
+class ClassCache:
+    """
+    Cache per classe/scuola delle sezioni già analizzate (es. registro compiti).
+    La chiave è un'impronta economica del dato grezzo ('fingerprint'): solo i
+    campi che il parser usa, senza serializzare tutta la risposta, altrimenti
+    calcolare la chiave costa più che rianalizzare.
+    Gli oggetti restituiti sono condivisi tra studenti: vanno trattati in sola lettura.
+    """
+    def __init__(self, maxsize=CLASS_CACHE_SIZE, ttl=CLASS_CACHE_TTL):
+        self._items = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get_or_parse(self, kind, scope, raw, parse, fingerprint):
+        """fingerprint(raw) -> valore hashable che cambia quando cambia il risultato di parse(raw)."""
+        if scope is None:
+            return parse(raw)
+        key = (kind, scope, fingerprint(raw))
+        parsed = self._items.get(key)
+        if parsed is None:
+            parsed = parse(raw)
+            self._items.set(key, parsed)
+        return parsed
+
+    def stats(self):
+        return self._items.stats()
+
+
+class_cache = ClassCache()
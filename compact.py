@@ -0,0 +1,100 @@
+from flask import request
+
+# Schema compatto (v2) per /login, /sync e /sync/batch.
+# Lo schema v1 ripete ogni campo in italiano e in inglese (materia/subject,
+# valore/value, ...): con v2 ogni campo compare una sola volta.
+# Negoziazione: header 'X-Schema-Version: 2' oppure ?schema=2.
+# Con ?layout=columnar (o 'X-Schema-Layout: columnar') i voti sono inviati per colonne.
+SCHEMA_HEADER = "X-Schema-Version"
+LAYOUT_HEADER = "X-Schema-Layout"
+COMPACT_SCHEMA_VERSION = 2
+
+GRADE_FIELDS = ("id", "subject", "value", "date", "type", "weight")
+TASK_FIELDS = ("id", "text", "subject", "due", "done")
+MEMO_FIELDS = ("title", "text", "author", "date", "url")
+
+
+def response_schema():
+    """Ritorna (versione, colonnare) richiesti dal client per la richiesta corrente."""
+    raw = request.headers.get(SCHEMA_HEADER) or request.args.get("schema") or "1"
+    try:
+        version = int(raw)
+    except ValueError:
+        version = 1
+    layout = request.headers.get(LAYOUT_HEADER) or request.args.get("layout") or ""
+    return version, layout.lower() == "columnar"
+
+
+def compact_grade(g):
+    return {
+        "id": g.get("id"),
+        "subject": g.get("materia") or g.get("subject"),
+        "value": g.get("valore") if g.get("valore") is not None else g.get("value"),
+        "date": g.get("data") or g.get("date"),
+        "type": g.get("tipo"),
+        "weight": g.get("peso"),
+    }
+
+
+def compact_task(t):
+    return {
+        "id": t.get("id"),
+        "text": t.get("text"),
+        "subject": t.get("subject") or t.get("materia"),
+        "due": t.get("due_date") or t.get("datCompito"),
+        "done": t.get("done", False),
+    }
+
+
+def compact_memo(m):
+    return {
+        "title": m.get("titolo") or m.get("oggetto"),
+        "text": m.get("testo"),
+        "author": m.get("autore"),
+        "date": m.get("data") or m.get("date"),
+        "url": m.get("url"),
+    }
+
+
+def to_columns(rows, fields):
+    """
+    Lista di dict -> {"count", "columns": {campo: [valori]}}.
+    Le materie sono ripetute su ogni voto: vengono codificate con un
+    dizionario ("subjects") e la colonna contiene solo l'indice.
+    """
+    columns = {f: [r.get(f) for r in rows] for f in fields}
+    out = {"count": len(rows), "columns": columns}
+    if "subject" in columns:
+        index = {}
+        columns["subject"] = [index.setdefault(s, len(index)) for s in columns["subject"]]
+        out["subjects"] = list(index)
+    return out
+
+
+def compact_payload(payload, columnar=False):
+    """
+    Converte in schema v2 le sezioni tasks/voti/promemoria di una risposta
+    (anche annidate in 'profiles' per /sync/batch). Gli altri campi restano invariati.
+    """
+    out = dict(payload)
+    if "voti" in out:
+        grades = [compact_grade(g) for g in out["voti"] or []]
+        out["voti"] = to_columns(grades, GRADE_FIELDS) if columnar else grades
+    if "tasks" in out:
+        out["tasks"] = [compact_task(t) for t in out["tasks"] or []]
+    if "promemoria" in out:
+        out["promemoria"] = [compact_memo(m) for m in out["promemoria"] or []]
+    if isinstance(out.get("profiles"), list):
+        out["profiles"] = [compact_payload(p, columnar) if isinstance(p, dict) else p
+                           for p in out["profiles"]]
+    return out
+
+
+def negotiate_payload(payload):
+    """Applica lo schema richiesto dal client (v1 = payload invariato)."""
+    version, columnar = response_schema()
+    if version < COMPACT_SCHEMA_VERSION:
+        return payload
+    out = compact_payload(payload, columnar)
+    out["schema"] = COMPACT_SCHEMA_VERSION
+    return out
@@ -0,0 +1,92 @@
+import os
+import gzip
+
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # senza orjson si usa l'encoder della libreria standard
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # senza brotli si comprime solo in gzip
+    brotli = None
+
+# Sotto questa soglia la compressione costa più CPU di quanta banda risparmia
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+COMPRESSIBLE_TYPES = ("application/json", "application/javascript", "application/xml",
+                      "image/svg+xml", "text/calendar", "text/html", "text/plain", "text/css")
+# Le immagini (avatar, upload) sono già compresse: non vanno ricompresse
+SKIP_STATUSES = (204, 206, 304)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    jsonify() con orjson quando disponibile (molto più veloce su /sync, /login, post).
+    Stessa resa dell'encoder di default per date, UUID e dataclass; le chiavi
+    mantengono l'ordine di inserimento invece di essere ordinate.
+    """
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        if kwargs.get("sort_keys"):
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+        except TypeError:
+            # es. interi oltre 64 bit: ripiega sull'encoder standard
+            return super().dumps(obj, **kwargs)
+
+
+def choose_encoding():
+    """Codifica migliore tra quelle accettate dal client (brotli > gzip), o None."""
+    available = ["br", "gzip"] if brotli else ["gzip"]
+    return request.accept_encodings.best_match(available)
+
+
+def compress_body(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def compress_response(response):
+    """after_request: comprime le risposte testuali sopra COMPRESS_MIN_BYTES."""
+    if (response.direct_passthrough or response.is_streamed  # file e stream SSE
+            or response.status_code < 200 or response.status_code in SKIP_STATUSES
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES
+            or "no-transform" in (response.headers.get("Cache-Control") or "")):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding()
+    if not encoding:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    response.set_data(compress_body(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    # Il corpo compresso non è identico byte per byte: ETag forte -> debole
+    # (il planner confronta gli ETag in modo debole, quindi 304/412 restano validi)
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def register_compression(app):
+    """Encoder JSON veloce + compressione gzip/brotli secondo Accept-Encoding."""
+    app.json = FastJSONProvider(app)
+    app.after_request(compress_response)
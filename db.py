@@ -0,0 +1,198 @@
+# Accesso a Supabase condiviso da server.py e planner_routes.py:
+# - un solo pool di connessioni per processo (requests per REST/Storage, httpx per il client supabase)
+# - timeout di default su ogni chiamata
+# - retry automatici solo per letture idempotenti (GET/HEAD) su errori 502/503/504
+# - tempi per tabella/operazione, consultabili con stats()
+# - client supabase creato al primo uso (LazyClient): avvio a freddo più rapido
+import os
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+DB_READ_TIMEOUT = float(os.getenv("DB_READ_TIMEOUT", "15"))
+DB_READ_RETRIES = 2
+RETRY_STATUSES = (502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD")
+
+
+def sb_headers():
+    url, key = os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    if not url or not key:
+        raise RuntimeError("Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY env vars")
+    return {
+        "apikey": key,
+        "Authorization": f"Bearer {key}",
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+    }
+
+
+def sb_table_url(table: str):
+    return f"{os.getenv('SUPABASE_URL')}/rest/v1/{table}"
+
+
+# ============= METRICHE =============
+
+_stats_lock = threading.Lock()
+_stats = {}  # "rest:profiles GET" -> {count, errors, total_ms, max_ms}
+
+
+def label_for(method, path):
+    """'/rest/v1/profiles' -> 'rest:profiles GET', '/rest/v1/rpc/fn' -> 'rpc:fn POST'."""
+    parts = [p for p in path.split("/") if p]
+    if len(parts) >= 3 and parts[0] in ("rest", "storage") and parts[1] == "v1":
+        if parts[0] == "rest":
+            target = f"rpc:{parts[3]}" if parts[2] == "rpc" and len(parts) > 3 else f"rest:{parts[2]}"
+        else:
+            # /storage/v1/object[/public]/<bucket>/...
+            rest = parts[3:] if len(parts) > 3 and parts[3] == "public" else parts[2:]
+            target = f"storage:{rest[1] if len(rest) > 1 else rest[0]}"
+    else:
+        target = "/".join(parts[:2]) or "/"
+    return f"{target} {method}"
+
+
+def record(label, elapsed_ms, ok=True):
+    with _stats_lock:
+        s = _stats.setdefault(label, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+        s["count"] += 1
+        s["total_ms"] += elapsed_ms
+        s["max_ms"] = max(s["max_ms"], elapsed_ms)
+        if not ok:
+            s["errors"] += 1
+
+
+def stats():
+    with _stats_lock:
+        return {
+            label: {**s, "total_ms": round(s["total_ms"], 1), "max_ms": round(s["max_ms"], 1),
+                    "avg_ms": round(s["total_ms"] / s["count"], 1) if s["count"] else 0.0}
+            for label, s in sorted(_stats.items())
+        }
+
+
+# ============= REQUESTS (REST / Storage) =============
+
+class _TimedAdapter(HTTPAdapter):
+    """HTTPAdapter con timeout di default e misura dei tempi per tabella."""
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = (DB_CONNECT_TIMEOUT, DB_READ_TIMEOUT)
+        label = label_for(request.method, requests.utils.urlparse(request.url).path)
+        start = time.perf_counter()
+        try:
+            response = super().send(request, timeout=timeout, **kwargs)
+        except Exception:
+            record(label, (time.perf_counter() - start) * 1000, ok=False)
+            raise
+        record(label, (time.perf_counter() - start) * 1000, ok=response.status_code < 400)
+        return response
+
+
+def _make_session():
+    s = requests.Session()
+    adapter = _TimedAdapter(
+        pool_connections=4,
+        pool_maxsize=DB_POOL_SIZE,
+        max_retries=Retry(
+            total=DB_READ_RETRIES,
+            backoff_factor=0.2,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=IDEMPOTENT_METHODS,
+            raise_on_status=False,
+        ),
+    )
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+# Sessione condivisa (thread-safe per l'uso che ne facciamo: una richiesta per chiamata)
+session = _make_session()
+
+
+# ============= HTTPX (client supabase) =============
+
+def _timed_transport_class(httpx):
+    class _TimedTransport(httpx.HTTPTransport):
+        """Trasporto httpx con retry sulle letture idempotenti e misura dei tempi."""
+        def handle_request(self, request):
+            label = label_for(request.method, request.url.path)
+            attempts = DB_READ_RETRIES + 1 if request.method in IDEMPOTENT_METHODS else 1
+            start = time.perf_counter()
+            for attempt in range(attempts):
+                try:
+                    response = super().handle_request(request)
+                except Exception:
+                    record(label, (time.perf_counter() - start) * 1000, ok=False)
+                    raise
+                if response.status_code in RETRY_STATUSES and attempt < attempts - 1:
+                    response.close()
+                    time.sleep(0.2 * (2 ** attempt))
+                    continue
+                break
+            record(label, (time.perf_counter() - start) * 1000, ok=response.status_code < 400)
+            return response
+    return _TimedTransport
+
+
+def make_supabase_http_client():
+    """Client httpx da passare a supabase (ClientOptions.httpx_client)."""
+    import httpx  # importato solo quando serve il client supabase
+    return httpx.Client(
+        transport=_timed_transport_class(httpx)(
+            http2=True,
+            retries=1,  # solo errori di connessione: sicuro anche per le scritture
+            limits=httpx.Limits(max_connections=DB_POOL_SIZE, max_keepalive_connections=DB_POOL_SIZE),
+        ),
+        timeout=httpx.Timeout(DB_READ_TIMEOUT, connect=DB_CONNECT_TIMEOUT),
+        follow_redirects=True,
+    )
+
+
+# ============= INIZIALIZZAZIONE PIGRA =============
+
+class LazyClient:
+    """
+    Proxy thread-safe verso un client costoso da creare (es. supabase):
+    factory() viene chiamata una sola volta, al primo uso.
+    - bool(proxy) è False se factory() ritorna None o fallisce (come 'client = None')
+    - gli attributi sono inoltrati al client reale
+    """
+    def __init__(self, factory, on_error=None):
+        self._factory = factory
+        self._on_error = on_error
+        self._client = None
+        self._done = False
+        self._lock = threading.Lock()
+        self.init_seconds = None
+
+    def get(self):
+        if self._done:
+            return self._client
+        with self._lock:
+            if not self._done:
+                start = time.perf_counter()
+                try:
+                    self._client = self._factory()
+                except Exception as e:
+                    self._client = None
+                    if self._on_error:
+                        self._on_error(e)
+                self.init_seconds = round(time.perf_counter() - start, 3)
+                self._done = True
+        return self._client
+
+    def __bool__(self):
+        return self.get() is not None
+
+    def __getattr__(self, name):
+        client = self.get()
+        if client is None:
+            raise RuntimeError("Client non disponibile")
+        return getattr(client, name)
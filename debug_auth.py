@@ -1,154 +1,121 @@
-import requests
-import secrets
-import re
-import base64
-from hashlib import sha256
+"""
+Diagnostica del login Argo: esegue il flusso OAuth N volte e riporta i tempi
+di ogni fase (challenge, sso, redirect-N, token, argo-login), per capire se la
+lentezza è lato nostro o lato Argo.
+
+    python debug_auth.py --school SG12345 --username mario.rossi -n 10
+    ARGO_PASSWORD=... python debug_auth.py --school SG12345 --username mario.rossi --json
+
+La password si legge da --password, ARGO_PASSWORD o viene chiesta a terminale.
+"""
+import os
+import sys
 import json
+import time
+import argparse
+import getpass
+import statistics
+
+from argo_auth import oauth_login
+from timing import StageTimer
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[k]
+
 
-# Constants
-CHALLENGE_URL = "https://auth.portaleargo.it/oauth2/auth"
-LOGIN_URL = "https://www.portaleargo.it/auth/sso/login"
-TOKEN_URL = "https://auth.portaleargo.it/oauth2/token"
-REDIRECT_URI = "it.argosoft.didup.famiglia.new://login-callback"
-CLIENT_ID = "72fd6dea-d0ab-4bb9-8eaa-3ac24c84886c"
-ENDPOINT = "https://www.portaleargo.it/appfamiglia/api/rest/"
-USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/106.0.0.0 Safari/537.36"
-
-def debug_login(school, username, password):
-    print(f"🔹 Starting Debug Login for {username} @ {school}")
-    
+def run_once(school, username, password):
+    """Un login completo: ritorna (tempi per fase in ms, numero profili, errore)."""
+    timer = StageTimer()
+    start = time.perf_counter()
+    profiles, error = None, None
     try:
-        # 1. Challenge
-        print("1️⃣ Requesting Challenge...")
-        CODE_VERIFIER = secrets.token_hex(64)
-        CODE_CHALLENGE = base64.urlsafe_b64encode(sha256(CODE_VERIFIER.encode()).digest()).decode().replace("=", "")
-        
-        session = requests.Session()
-        # Headers mimicking a browser might help, though library doesn't strictly set them for auth flow
-        session.headers.update({"User-Agent": USER_AGENT})
-
-        params = {
-            "redirect_uri": REDIRECT_URI,
-            "client_id": CLIENT_ID,
-            "response_type": "code",
-            "prompt": "login",
-            "state": secrets.token_urlsafe(32),
-            "scope": "openid offline profile user.roles argo",
-            "code_challenge": CODE_CHALLENGE,
-            "code_challenge_method": "S256"
-        }
-        
-        req = session.get(CHALLENGE_URL, params=params)
-        print(f"   Challenge URL: {req.url[:100]}...")
-        
-        challenge_match = re.search(r"login_challenge=([0-9a-f]+)", req.url)
-        if not challenge_match:
-            print("❌ Challenge NOT found in URL")
-            print("   Full URL:", req.url)
-            return
-        
-        login_challenge = challenge_match.group(1)
-        print(f"   Challenge ID: {login_challenge}")
-        
-        # 2. Login POST
-        print("2️⃣ Posting Credentials...")
-        login_data = {
-            "challenge": login_challenge,
-            "client_id": CLIENT_ID,
-            "prefill": "true",
-            "famiglia_customer_code": school,
-            "username": username,
-            "password": password,
-            "login": "true"
-        }
-        
-        req = session.post(LOGIN_URL, data=login_data, allow_redirects=False)
-        print(f"   Status: {req.status_code}")
-        print(f"   Headers: {dict(req.headers)}")
-        
-        if "Location" not in req.headers:
-            print("❌ 'Location' header missing. Login failed.")
-            print("   Response Body Preview:", req.text[:500])
-            return
-
-        # 3. Follow Redirects
-        print("3️⃣ Following Redirects...")
-        location = req.headers["Location"]
-        while True:
-            print(f"   Redirecting to: {location[:50]}...")
-            if "code=" in location:
-                break
-            req = session.get(location, allow_redirects=False)
-            if "Location" not in req.headers:
-                print("❌ Redirect chain broken")
-                return
-            location = req.headers["Location"]
-            
-        code_match = re.search(r"code=([0-9a-zA-Z-_.]+)", location)
-        if not code_match:
-             print("❌ Auth Code NOT found")
-             return
-        code = code_match.group(1)
-        print(f"   Auth Code: {code[:20]}...")
-
-        # 4. Token Exchange
-        print("4️⃣ Exchanging Token...")
-        token_req_data = {
-            "code": code,
-            "grant_type": "authorization_code",
-            "redirect_uri": REDIRECT_URI,
-            "code_verifier": CODE_VERIFIER,
-            "client_id": CLIENT_ID
-        }
-        
-        token_resp = session.post(TOKEN_URL, data=token_req_data)
-        if token_resp.status_code != 200:
-            print(f"❌ Token Exchange Failed: {token_resp.status_code}")
-            print(token_resp.text)
-            return
-            
-        tokens = token_resp.json()
-        access_token = tokens.get("access_token")
-        print(f"   Access Token obtained: {access_token[:20]}...")
-        
-        # 5. Argo Login (Get Profiles)
-        print("5️⃣ Calling Argo Login API...")
-        login_headers = {
-            "User-Agent": USER_AGENT,
-            "Content-Type": "Application/json",
-            "Authorization": "Bearer " + access_token,
-            "Accept": "Application/json",
-        }
-        
-        payload = {
-            "clientID": secrets.token_urlsafe(64),
-            "lista-x-auth-token": "[]",
-            "x-auth-token-corrente": "null",
-            "lista-opzioni-notifiche": "{}"
+        _, soggetti = oauth_login(school, username, password, timer)
+        profiles = len(soggetti)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    stages = {name: ms for name, ms in timer.stages}
+    stages["total"] = (time.perf_counter() - start) * 1000
+    return stages, profiles, error
+
+
+def summarize(runs):
+    """{fase: {n, min, median, p90, max, mean}} su tutte le esecuzioni (ordine del flusso)."""
+    order, samples = [], {}
+    for stages, _, _ in runs:
+        for name, ms in stages.items():
+            if name not in samples:
+                order.append(name)
+                samples[name] = []
+            samples[name].append(ms)
+    # 'total' sempre in fondo
+    order = [n for n in order if n != "total"] + ["total"]
+    return {
+        name: {
+            "n": len(samples[name]),
+            "min": round(min(samples[name]), 1),
+            "median": round(statistics.median(samples[name]), 1),
+            "p90": round(percentile(samples[name], 90), 1),
+            "max": round(max(samples[name]), 1),
+            "mean": round(statistics.fmean(samples[name]), 1),
         }
-        
-        argo_resp = requests.post(ENDPOINT + "login", headers=login_headers, json=payload)
-        data = argo_resp.json()
-        
-        if "data" in data:
-            profiles = data["data"]
-            print(f"✅ SUCCESS! Found {len(profiles)} profiles.")
-            for p in profiles:
-                # Mask token for security in logs
-                limit_token = p.get('token', '')[:10] + "..."
-                print(f"   - {p.get('alunno', {}).get('desNome')} (Token: {limit_token})")
-        else:
-            print("❌ No data in Argo response")
-            print(data)
+        for name in order
+    }
+
+
+def print_table(summary, runs):
+    errors = [e for _, _, e in runs if e]
+    print(f"\nRuns: {len(runs)}  OK: {len(runs) - len(errors)}  Errori: {len(errors)}")
+    header = f"{'fase':<14}{'n':>4}{'min':>10}{'median':>10}{'p90':>10}{'max':>10}{'mean':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, s in summary.items():
+        print(f"{name:<14}{s['n']:>4}{s['min']:>10.1f}{s['median']:>10.1f}"
+              f"{s['p90']:>10.1f}{s['max']:>10.1f}{s['mean']:>10.1f}")
+    print("(ms)")
+    for e in sorted(set(errors)):
+        print(f"❌ {e}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tempi per fase del login OAuth Argo su N esecuzioni.")
+    parser.add_argument("--school", default=os.environ.get("ARGO_SCHOOL"), help="codice scuola (ARGO_SCHOOL)")
+    parser.add_argument("--username", default=os.environ.get("ARGO_USERNAME"), help="utente (ARGO_USERNAME)")
+    parser.add_argument("--password", default=os.environ.get("ARGO_PASSWORD"), help="password (ARGO_PASSWORD)")
+    parser.add_argument("-n", "--runs", type=int, default=5, help="numero di login (default 5)")
+    parser.add_argument("--delay", type=float, default=1.0, help="pausa tra i login in secondi (default 1)")
+    parser.add_argument("--json", action="store_true", help="output JSON (singole esecuzioni + riepilogo)")
+    args = parser.parse_args(argv)
+
+    if not args.school or not args.username:
+        parser.error("--school e --username sono obbligatori")
+    school = args.school.strip().upper()
+    username = args.username.strip().lower()
+    password = args.password or getpass.getpass("Password Argo: ")
+
+    runs = []
+    for i in range(args.runs):
+        if i and args.delay:
+            time.sleep(args.delay)
+        stages, profiles, error = run_once(school, username, password)
+        runs.append((stages, profiles, error))
+        if not args.json:
+            status = f"❌ {error}" if error else f"✅ {profiles} profili"
+            print(f"#{i + 1:<3} {stages['total']:8.1f} ms  {status}", file=sys.stderr)
+
+    summary = summarize(runs)
+    if args.json:
+        print(json.dumps({
+            "runs": [{"stages": {k: round(v, 1) for k, v in s.items()}, "profiles": p, "error": e}
+                     for s, p, e in runs],
+            "summary": summary,
+        }, indent=2, ensure_ascii=False))
+    else:
+        print_table(summary, runs)
+    return 1 if all(e for _, _, e in runs) else 0
 
-    except Exception as e:
-        print(f"❌ EXCEPTION: {str(e)}")
-        import traceback
-        traceback.print_exc()
 
 if __name__ == "__main__":
-    # Placeholder for user to fill or I will mock if I can't ask
-    # But I can't ask credentials. I will rely on the user running this or me running it if I had creds (I don't).
-    # Since I cannot get credentials, I will inspect the code again. 
-    # WAIT, I can import the logic to server.py and expose a debug endpoint that calls THIS logic with the creds sent by the frontend.
-    print("This script is a template. Run via server debug endpoint.")
+    sys.exit(main())
@@ -0,0 +1,193 @@
+import os
+import re
+from datetime import date
+
+from cache import TTLCache
+from snapshots import content_hash
+
+# Statistiche voti calcolate lato server (medie, medie pesate, andamento).
+# Il risultato è in cache per hash dei voti: si ricalcola solo se i voti cambiano.
+
+# Inizio del secondo periodo (mese, giorno): quadrimestri con scrutinio a fine gennaio
+GRADE_PERIOD_SPLIT = tuple(int(x) for x in os.getenv("GRADE_PERIOD_SPLIT", "02-01").split("-"))
+TREND_WINDOW = 6          # ultimi N voti usati per l'andamento
+TREND_FLAT_THRESHOLD = 0.1  # punti ogni 30 giorni sotto cui l'andamento è "stabile"
+
+stats_cache = TTLCache(maxsize=2000, ttl=6 * 3600)
+
+_GRADE_RE = re.compile(
+    r"^(?P<base>\d{1,2}(?:[.,]\d+)?)\s*"
+    r"(?P<mod>\+\+|--|\+|-|½|1/2|e\s*mezzo|mezzo|l|lode|e\s*lode)?$"
+)
+_RANGE_RE = re.compile(r"^(\d{1,2})\s*([/-])\s*(\d{1,2})$")  # "6/7", "6-7" -> 6.5
+_MODIFIERS = {
+    "+": 0.25, "++": 0.5, "-": -0.25, "--": -0.5,
+    "½": 0.5, "1/2": 0.5, "mezzo": 0.5, "emezzo": 0.5,
+    "l": 0.0, "lode": 0.0, "elode": 0.0,
+}
+
+
+def parse_grade(value):
+    """
+    Voto in notazione italiana -> float (0-10), None se non numerico.
+    "7+" -> 7.25, "8-" -> 7.75, "6½" / "6 e mezzo" -> 6.5, "6/7" -> 6.5,
+    "7,5" -> 7.5, "10 e lode" -> 10. Giudizi ("buono", "NC", "S") -> None.
+    Il voto intermedio vale solo per "n/n+1" con entrambi i voti tra 1 e 10:
+    "1/2" (un mezzo), "3/5", "10/11" e simili -> None.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        grade = float(value)
+    else:
+        text = str(value).strip().lower()
+        if not text:
+            return None
+        m = _RANGE_RE.match(text)
+        if m:
+            low, sep, high = int(m.group(1)), m.group(2), int(m.group(3))
+            if not (1 <= low and high <= 10 and high == low + 1) or (sep == "/" and low == 1):
+                return None
+            grade = low + 0.5
+        else:
+            m = _GRADE_RE.match(text)
+            if not m:
+                return None
+            grade = float(m.group("base").replace(",", "."))
+            mod = (m.group("mod") or "").replace(" ", "")
+            grade += _MODIFIERS.get(mod, 0.0)
+    if not 0 <= grade <= 10.5:
+        return None
+    return min(grade, 10.0)
+
+
+def parse_weight(value):
+    """numPeso Argo ('100' = peso pieno) -> fattore (1.0). Default 1.0."""
+    try:
+        weight = float(str(value).replace(",", "."))
+    except (TypeError, ValueError):
+        return 1.0
+    return weight / 100.0 if weight > 0 else 0.0
+
+
+def parse_date(value):
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except (TypeError, ValueError):
+        return None
+
+
+def period_of(day):
+    """Periodo scolastico di una data: '2025-26/1' (settembre-gennaio) o '2025-26/2'."""
+    if day is None:
+        return None
+    start_year = day.year if day.month >= 8 else day.year - 1
+    second = (day.month, day.day) >= GRADE_PERIOD_SPLIT and day.month < 8
+    return f"{start_year}-{str(start_year + 1)[2:]}/{2 if second else 1}"
+
+
+class _Acc:
+    """Accumulatore di somme per medie semplici e pesate."""
+    __slots__ = ("count", "total", "weighted", "weights")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.weighted = 0.0
+        self.weights = 0.0
+
+    def add(self, grade, weight):
+        self.count += 1
+        self.total += grade
+        self.weighted += grade * weight
+        self.weights += weight
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "average": round(self.total / self.count, 2) if self.count else None,
+            "weightedAverage": round(self.weighted / self.weights, 2) if self.weights else None,
+        }
+
+
+def trend(points):
+    """
+    Andamento sugli ultimi TREND_WINDOW voti: pendenza della retta ai minimi
+    quadrati (punti ogni 30 giorni) e direzione up/down/flat.
+    """
+    points = [p for p in points if p[0] is not None][-TREND_WINDOW:]
+    if len(points) < 2:
+        return None
+    origin = points[0][0]
+    xs = [(d - origin).days / 30.0 for d, _ in points]
+    ys = [g for _, g in points]
+    n = len(points)
+    mean_x, mean_y = sum(xs) / n, sum(ys) / n
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x == 0:
+        return None
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    direction = "flat"
+    if slope > TREND_FLAT_THRESHOLD:
+        direction = "up"
+    elif slope < -TREND_FLAT_THRESHOLD:
+        direction = "down"
+    return {"slope": round(slope, 2), "direction": direction, "samples": n}
+
+
+def compute_grade_stats(grades):
+    """
+    Statistiche per materia, per periodo e complessive in un solo passaggio
+    sulla lista dei voti (schema /sync: materia, valore, data, peso).
+    """
+    overall = _Acc()
+    periods = {}
+    subjects = {}  # materia -> {"acc", "periods", "points"}
+    unparsed = 0
+
+    for g in grades or []:
+        value = parse_grade(g.get("valore") if g.get("valore") is not None else g.get("value"))
+        if value is None:
+            unparsed += 1
+            continue
+        weight = parse_weight(g.get("peso", 100))
+        day = parse_date(g.get("data") or g.get("date"))
+        period = period_of(day)
+        subject = g.get("materia") or g.get("subject") or "N/D"
+
+        overall.add(value, weight)
+        if period:
+            periods.setdefault(period, _Acc()).add(value, weight)
+        s = subjects.setdefault(subject, {"acc": _Acc(), "periods": {}, "points": []})
+        s["acc"].add(value, weight)
+        if period:
+            s["periods"].setdefault(period, _Acc()).add(value, weight)
+        s["points"].append((day, value))
+
+    subject_stats = []
+    for name, s in sorted(subjects.items()):
+        points = sorted(s["points"], key=lambda p: p[0] or date.min)
+        subject_stats.append({
+            "subject": name,
+            **s["acc"].summary(),
+            "last": points[-1][1] if points else None,
+            "trend": trend(points),
+            "periods": {p: acc.summary() for p, acc in sorted(s["periods"].items())},
+        })
+
+    return {
+        "overall": overall.summary(),
+        "periods": {p: acc.summary() for p, acc in sorted(periods.items())},
+        "subjects": subject_stats,
+        "unparsed": unparsed,
+    }
+
+
+def grade_stats(grades):
+    """compute_grade_stats con cache per hash dei voti (ignora gli id casuali)."""
+    key = content_hash(grades or [])
+    stats = stats_cache.get(key)
+    if stats is None:
+        stats = compute_grade_stats(grades)
+        stats_cache.set(key, stats)
+    return stats
@@ -0,0 +1,39 @@
+# Configurazione gunicorn per il backend Python (server:app).
+#   gunicorn -c gunicorn.conf.py server:app
+#
+# Quasi tutto il tempo di una richiesta è attesa su Argo e Supabase, quindi
+# servono molte richieste in volo per worker:
+# - gthread (default): WEB_CONCURRENCY processi x GUNICORN_THREADS thread
+# - gevent (GUNICORN_WORKER_CLASS=gevent, richiede 'pip install gevent'):
+#   centinaia di greenlet per processo, utile con molti stream SSE aperti
+# Con più worker lo stato condiviso non può stare in lock di processo: i voti dei
+# sondaggi sono atomici su Supabase (POLL_VOTE.sql) e polls.json usa un flock.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+
+# gthread: ogni richiesta (anche uno stream SSE aperto) occupa un thread; gli stream
+# per worker sono limitati a un quarto dei thread (SSE_MAX_STREAMS in server.py),
+# oltre rispondono 503 e il client riprova: le API non restano senza thread
+threads = int(os.environ.get("GUNICORN_THREADS", "64"))
+# gevent: richieste contemporanee per processo
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "500"))
+
+# Login + sync Argo possono superare i 30 s di default
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+# Ricicla i worker ogni tanto (memoria), sfalsati per non riavviarli tutti insieme
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "2000"))
+max_requests_jitter = 200
+
+# Niente preload: client supabase, pool HTTP e thread di background
+# (write-behind, bridge pub/sub) vanno creati dopo il fork, in ogni worker
+preload_app = False
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "info")
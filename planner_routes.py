@@ -1,29 +1,247 @@
 import os
+import re
+import copy
 import requests
+from hashlib import sha256
 from datetime import datetime, timezone
 from flask import request, jsonify, Flask
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-
-def sb_headers():
-    if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
-        raise RuntimeError("Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY env vars")
-    return {
-        "apikey": SUPABASE_SERVICE_ROLE_KEY,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
+from urllib.parse import unquote
+from cache import TTLCache
+from db import session, sb_headers, sb_table_url
+
+PLANNER_COLUMNS = "user_id,planned_tasks,stress_levels,planned_details,updated_at"
+
+# Cache per-utente dell'ultimo documento letto/scritto (riga Supabase, con updated_at).
+# Aggiornata da GET/PUT/PATCH di questo processo. Con più worker gunicorn una voce
+# può essere vecchia: GET la usa solo se il suo updated_at coincide con quello
+# attuale (query leggera, senza i blob) e le scritture condizionate (If-Match)
+# rileggono sempre la riga da Supabase.
+PLANNER_CACHE_SIZE = int(os.getenv("PLANNER_CACHE_SIZE", "1000"))
+PLANNER_CACHE_TTL = int(os.getenv("PLANNER_CACHE_TTL", "60"))
+planner_cache = TTLCache(maxsize=PLANNER_CACHE_SIZE, ttl=PLANNER_CACHE_TTL)
+
+# Frazione di secondo di lunghezza variabile (PostgREST: ".12", Python: ".120000")
+FRACTION_RE = re.compile(r"\.(\d+)")
+
+def parse_updated_at(updated_at):
+    """updated_at (stringa ISO di Python o di Postgres) -> datetime UTC, o None."""
+    if not updated_at:
+        return None
+    if isinstance(updated_at, datetime):
+        parsed = updated_at
+    else:
+        text = str(updated_at).strip().replace("Z", "+00:00").replace(" ", "T", 1)
+        text = FRACTION_RE.sub(lambda m: "." + m.group(1)[:6].ljust(6, "0"), text, count=1)
+        try:
+            parsed = datetime.fromisoformat(text)
+        except ValueError:
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+def planner_etag(updated_at):
+    """
+    ETag del documento planner: cambia solo quando cambia updated_at.
+    Si calcola sulla forma canonica del timestamp, così la stessa versione ha lo
+    stesso ETag sia da Python (isoformat) sia riletta da PostgREST.
+    """
+    parsed = parse_updated_at(updated_at)
+    canonical = parsed.isoformat(timespec="microseconds") if parsed else str(updated_at)
+    return sha256(canonical.encode()).hexdigest()[:20]
+
+def same_version(a, b):
+    """True se due updated_at indicano la stessa versione (anche con formati diversi)."""
+    if not a or not b:
+        return not a and not b
+    return planner_etag(a) == planner_etag(b)
+
+def is_not_modified(updated_at):
+    """Valuta If-None-Match / If-Modified-Since rispetto alla versione corrente."""
+    if not updated_at:
+        return False
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(planner_etag(updated_at))
+    since = request.if_modified_since
+    modified = parse_updated_at(updated_at)
+    if since and modified:
+        # Last-Modified ha precisione al secondo
+        return modified.replace(microsecond=0) <= since
+    return False
+
+def with_version_headers(response, updated_at):
+    """Aggiunge ETag / Last-Modified e forza la rivalidazione lato client."""
+    if updated_at:
+        response.set_etag(planner_etag(updated_at))
+        modified = parse_updated_at(updated_at)
+        if modified:
+            response.last_modified = modified
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+def wants_minimal_response():
+    """PUT/PATCH senza eco del documento: header 'Prefer: return=minimal' o ?return=minimal."""
+    return ("return=minimal" in (request.headers.get("Prefer") or "")
+            or request.args.get("return") == "minimal")
+
+def fetch_planner_version(user_id):
+    """Solo updated_at dell'ultima riga: serve a rispondere 304 senza scaricare i blob."""
+    params = {
+        "select": "updated_at",
+        "user_id": f"eq.{user_id}",
+        "order": "updated_at.desc",
+        "limit": "1"
     }
+    r = session.get(sb_table_url("planner"), headers=sb_headers(), params=params)
+    r.raise_for_status()
+    rows = r.json() or []
+    return rows[0].get("updated_at") if rows else None
 
-def sb_table_url(table: str):
-    return f"{SUPABASE_URL}/rest/v1/{table}"
+# Campi del documento planner: chiave API -> colonna Supabase
+PLANNER_FIELDS = {
+    "plannedTasks": "planned_tasks",
+    "stressLevels": "stress_levels",
+    "plannedDetails": "planned_details",
+}
+PATCH_MAX_RETRIES = 3
 
-from urllib.parse import unquote
+class PatchError(ValueError):
+    pass
+
+def merge_patch(target, patch):
+    """JSON Merge Patch (RFC 7396): null rimuove la chiave, gli oggetti si fondono ricorsivamente."""
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+def _pointer_parts(path):
+    if not path.startswith("/"):
+        raise PatchError(f"Path non valido: {path}")
+    return [p.replace("~1", "/").replace("~0", "~") for p in path[1:].split("/")]
+
+# Indice di array in un JSON Pointer: niente segni né zeri iniziali (RFC 6901 §4)
+ARRAY_INDEX_RE = re.compile(r"0|[1-9][0-9]*")
+
+def _array_index(items, token, path, allow_end=False):
+    """Indice esistente in items; con allow_end (solo add) anche len(items) o '-'."""
+    if allow_end and token == "-":
+        return len(items)
+    if not ARRAY_INDEX_RE.fullmatch(token):
+        raise PatchError(f"Indice non valido: {path}")
+    index = int(token)
+    if index > len(items) or (index == len(items) and not allow_end):
+        raise PatchError(f"Indice fuori intervallo: {path}")
+    return index
+
+def apply_json_patch(doc, ops):
+    """
+    JSON Patch (RFC 6902) con le operazioni add / replace / remove, in place.
+    I path partono dal campo del documento, es. "/plannedTasks/2024-10-07".
+    Come da RFC il genitore del target deve esistere (nessun oggetto intermedio
+    viene creato) e replace/remove richiedono che esista anche il target.
+    """
+    if not isinstance(ops, list):
+        raise PatchError("JSON Patch deve essere una lista di operazioni")
+    for op in ops:
+        if not isinstance(op, dict):
+            raise PatchError("Operazione JSON Patch non valida")
+        kind = op.get("op")
+        if kind not in ("add", "replace", "remove"):
+            raise PatchError(f"Operazione non supportata: {kind}")
+        path = op.get("path", "")
+        if not isinstance(path, str):
+            raise PatchError(f"Path non valido: {path}")
+        parts = _pointer_parts(path)
+        if parts[0] not in PLANNER_FIELDS or len(parts) < 2:
+            raise PatchError(f"Path non valido: {path}")
+        if kind != "remove" and "value" not in op:
+            raise PatchError(f"Valore mancante: {path}")
+        parent = doc
+        for part in parts[:-1]:
+            if isinstance(parent, list):
+                parent = parent[_array_index(parent, part, path)]
+            elif isinstance(parent, dict) and part in parent:
+                parent = parent[part]
+            else:
+                raise PatchError(f"Path inesistente: {path}")
+        last = parts[-1]
+        if isinstance(parent, list):
+            index = _array_index(parent, last, path, allow_end=(kind == "add"))
+            if kind == "add":
+                parent.insert(index, op["value"])
+            elif kind == "replace":
+                parent[index] = op["value"]
+            else:
+                del parent[index]
+        elif isinstance(parent, dict):
+            if kind != "add" and last not in parent:
+                raise PatchError(f"Path inesistente: {path}")
+            if kind == "remove":
+                del parent[last]
+            else:
+                parent[last] = op["value"]
+        else:
+            raise PatchError(f"Path inesistente: {path}")
+    return doc
+
+def apply_planner_patch(row, body, content_type):
+    """Applica merge-patch o JSON Patch al documento e ritorna le colonne da scrivere."""
+    doc = {api: copy.deepcopy((row or {}).get(col) or {}) for api, col in PLANNER_FIELDS.items()}
+    if content_type == "application/json-patch+json":
+        apply_json_patch(doc, body)
+    else:
+        if not isinstance(body, dict) or not set(body) <= set(PLANNER_FIELDS):
+            raise PatchError(f"Campi ammessi: {', '.join(PLANNER_FIELDS)}")
+        for api, changes in body.items():
+            doc[api] = merge_patch(doc[api], changes) if changes is not None else {}
+    return {PLANNER_FIELDS[api]: value for api, value in doc.items()}
+
+def fetch_planner_row(user_id):
+    params = {
+        "select": PLANNER_COLUMNS,
+        "user_id": f"eq.{user_id}",
+        "order": "updated_at.desc",
+        "limit": "1"
+    }
+    r = session.get(sb_table_url("planner"), headers=sb_headers(), params=params)
+    r.raise_for_status()
+    rows = r.json() or []
+    return rows[0] if rows else None
+
+def write_planner_if_unchanged(user_id, columns, base_updated_at):
+    """
+    Scrittura condizionata (compare-and-swap su updated_at).
+    Ritorna il nuovo updated_at, oppure None se nel frattempo qualcuno ha scritto.
+    """
+    new_updated_at = datetime.now(timezone.utc).isoformat()
+    payload = {**columns, "updated_at": new_updated_at}
+    headers = sb_headers()
+    if base_updated_at is None:
+        # Nessun documento: inserimento; se nel frattempo è stato creato -> conflitto
+        headers["Prefer"] = "return=minimal"
+        r = session.post(sb_table_url("planner"), headers=headers,
+                          json={"user_id": user_id, **payload})
+        if r.status_code == 409:
+            return None
+        r.raise_for_status()
+        return new_updated_at
+
+    headers["Prefer"] = "return=representation"
+    params = {"user_id": f"eq.{user_id}", "updated_at": f"eq.{base_updated_at}", "select": "updated_at"}
+    r = session.patch(sb_table_url("planner"), headers=headers, params=params, json=payload)
+    r.raise_for_status()
+    return new_updated_at if (r.json() or []) else None
 
 def register_planner_routes(app: Flask):
 
-    @app.route("/api/planner/<path:user_id>", methods=["GET", "PUT", "OPTIONS"])
+    @app.route("/api/planner/<path:user_id>", methods=["GET", "PUT", "PATCH", "OPTIONS"])
     def planner_manager(user_id):
         if request.method == "OPTIONS":
             return jsonify({"success": True}), 200
@@ -35,41 +253,29 @@ def register_planner_routes(app: Flask):
         # =========================
         if request.method == "GET":
             try:
-                url = sb_table_url("planner")
-                params = {
-                    "select": "user_id,planned_tasks,stress_levels,planned_details,updated_at",
-                    "user_id": f"eq.{user_id}",
-                    "order": "updated_at.desc",
-                    "limit": "1"
-                }
-                r = requests.get(url, headers=sb_headers(), params=params, timeout=15)
-                if not r.ok:
-                    return jsonify({"success": False, "error": r.text}), r.status_code
+                # Prima la sola versione: basta per il 304 e per validare la cache,
+                # che un altro worker può aver reso vecchia
+                version = fetch_planner_version(user_id)
+                if is_not_modified(version):
+                    return with_version_headers(app.response_class(status=304), version)
 
-                rows = r.json() or []
-                if not rows:
-                    return jsonify({
-                        "success": True,
-                        "data": {
-                            "userId": user_id,
-                            "plannedTasks": {},
-                            "stressLevels": {},
-                            "plannedDetails": {},
-                            "updatedAt": None
-                        }
-                    })
-
-                row = rows[0]
-                return jsonify({
+                row = planner_cache.get(user_id)
+                if row is None or not same_version(row.get("updated_at"), version):
+                    row = fetch_planner_row(user_id) or {"user_id": user_id, "updated_at": None}
+                    planner_cache.set(user_id, row)
+
+                return with_version_headers(jsonify({
                     "success": True,
                     "data": {
-                        "userId": row.get("user_id"),
+                        "userId": row.get("user_id") or user_id,
                         "plannedTasks": row.get("planned_tasks") or {},
                         "stressLevels": row.get("stress_levels") or {},
                         "plannedDetails": row.get("planned_details") or {},
                         "updatedAt": row.get("updated_at"),
                     }
-                })
+                }), row.get("updated_at"))
+            except requests.HTTPError as e:
+                return jsonify({"success": False, "error": e.response.text}), e.response.status_code
             except Exception as e:
                 return jsonify({"success": False, "error": str(e)}), 500
 
@@ -91,18 +297,29 @@ def register_planner_routes(app: Flask):
                     "updated_at": datetime.now(timezone.utc).isoformat(),
                 }
 
+                minimal = wants_minimal_response()
                 url = f"{sb_table_url('planner')}?on_conflict=user_id"
                 headers = sb_headers()
-                headers["Prefer"] = "resolution=merge-duplicates,return=representation"
+                headers["Prefer"] = "resolution=merge-duplicates," + ("return=minimal" if minimal else "return=representation")
 
-                r = requests.post(url, headers=headers, json=payload, timeout=15)
+                r = session.post(url, headers=headers, json=payload)
                 if not r.ok:
+                    planner_cache.pop(user_id)
                     return jsonify({"success": False, "error": r.text}), r.status_code
 
+                planner_cache.set(user_id, payload)
+
+                if minimal:
+                    # Il client ha già il documento: basta la nuova versione
+                    return with_version_headers(jsonify({
+                        "success": True,
+                        "data": {"userId": user_id, "updatedAt": payload["updated_at"]}
+                    }), payload["updated_at"])
+
                 rows = r.json() or []
                 row = rows[0] if rows else payload
 
-                return jsonify({
+                return with_version_headers(jsonify({
                     "success": True,
                     "data": {
                         "userId": row.get("user_id", user_id),
@@ -111,6 +328,50 @@ def register_planner_routes(app: Flask):
                         "plannedDetails": row.get("planned_details", planned_details),
                         "updatedAt": row.get("updated_at"),
                     }
-                })
+                }), row.get("updated_at"))
+            except Exception as e:
+                return jsonify({"success": False, "error": str(e)}), 500
+
+        # =========================
+        # PATCH → modifiche parziali
+        # =========================
+        # Content-Type: application/merge-patch+json (default) o application/json-patch+json.
+        # If-Match: <ETag> per fallire con 412 se il documento è cambiato nel frattempo;
+        # senza If-Match il patch viene riapplicato all'ultima versione (le chiavi non
+        # toccate da altri dispositivi non vanno perse).
+        if request.method == "PATCH":
+            try:
+                body = request.get_json(force=True, silent=True)
+                expected = list if request.mimetype == "application/json-patch+json" else dict
+                if not isinstance(body, expected):
+                    return jsonify({"success": False, "error": "Corpo JSON non valido"}), 400
+                if_match = request.if_match
+                # Con If-Match la base va letta fresca: una voce di cache vecchia (scritta
+                # da un altro worker) darebbe un 412 spurio. Senza, basta la CAS su updated_at.
+                row = None if if_match else planner_cache.get(user_id)
+                for _ in range(PATCH_MAX_RETRIES):
+                    if row is None:
+                        row = fetch_planner_row(user_id) or {"user_id": user_id, "updated_at": None}
+                    base = row.get("updated_at")
+                    matches = bool(base) and (if_match.star_tag or if_match.contains_weak(planner_etag(base)))
+                    if if_match and not matches:
+                        return with_version_headers(jsonify({
+                            "success": False, "error": "Planner modificato da un altro dispositivo",
+                            "data": {"userId": user_id, "updatedAt": base}
+                        }), base), 412
+                    columns = apply_planner_patch(row, body, request.mimetype)
+                    updated_at = write_planner_if_unchanged(user_id, columns, base)
+                    if updated_at:
+                        planner_cache.set(user_id, {"user_id": user_id, **columns, "updated_at": updated_at})
+                        return with_version_headers(jsonify({
+                            "success": True,
+                            "data": {"userId": user_id, "updatedAt": updated_at}
+                        }), updated_at)
+                    # CAS fallito: rilegge e riprova (con If-Match il giro successivo risponde 412)
+                    planner_cache.pop(user_id)
+                    row = None
+                return jsonify({"success": False, "error": "Conflitto di scrittura, riprova"}), 409
+            except PatchError as e:
+                return jsonify({"success": False, "error": str(e)}), 400
             except Exception as e:
                 return jsonify({"success": False, "error": str(e)}), 500
@@ -0,0 +1,206 @@
+import os
+import sys
+import time
+import uuid
+import random
+import threading
+from collections import Counter, deque
+
+from flask import Response, g, jsonify, request
+
+# Profiler statistico per richieste reali, attivabile senza redeploy:
+# - PROFILER_SAMPLE_RATE: frazione di richieste campionate (0 = spento, es. 0.01)
+# - header 'X-Profile: <PROFILER_TOKEN>': campiona quella richiesta
+# Un solo thread campionatore legge lo stack dei thread delle richieste in corso
+# ogni PROFILER_INTERVAL_MS; i profili finiscono in un buffer circolare in memoria,
+# letti da /admin/profiles (header 'X-Admin-Token: <PROFILER_TOKEN>').
+# Con worker gevent le richieste condividono il thread: i campioni sono affidabili
+# solo con worker gthread/sync.
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "5"))
+PROFILER_KEEP = int(os.getenv("PROFILER_KEEP", "50"))
+MAX_STACK_DEPTH = 64
+MAX_DISTINCT_STACKS = 5000  # per profilo: limita la memoria su richieste molto lunghe
+TOP_FRAMES = 25
+
+
+def profiler_token():
+    # token e frazione letti a ogni richiesta: valgono anche se il .env è caricato dopo l'import
+    return os.getenv("PROFILER_TOKEN")
+
+
+def sample_rate():
+    try:
+        return float(os.getenv("PROFILER_SAMPLE_RATE", "0"))
+    except ValueError:
+        return 0.0
+
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame):
+    """Stack come stringa 'radice;...;foglia' (formato 'collapsed' dei flamegraph)."""
+    labels = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class Sampler:
+    """Thread unico che campiona gli stack dei thread registrati."""
+    def __init__(self, interval_ms=PROFILER_INTERVAL_MS):
+        self.interval = interval_ms / 1000.0
+        self._active = {}  # thread id -> Counter(stack -> campioni)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._started = False
+
+    def start(self, thread_id):
+        with self._lock:
+            self._active[thread_id] = Counter()
+            if not self._started:
+                # avviato al primo uso: non sopravvive al fork dei worker gunicorn
+                self._started = True
+                threading.Thread(target=self._run, daemon=True, name="profiler").start()
+        self._wakeup.set()
+
+    def stop(self, thread_id):
+        with self._lock:
+            return self._active.pop(thread_id, Counter())
+
+    def _run(self):
+        while True:
+            with self._lock:
+                idle = not self._active
+            if idle:
+                # nessuna richiesta campionata: niente overhead finché non ne arriva una
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for tid, counter in self._active.items():
+                    frame = frames.get(tid)
+                    if frame is None:
+                        continue
+                    stack = collapse(frame)
+                    if stack in counter or len(counter) < MAX_DISTINCT_STACKS:
+                        counter[stack] += 1
+
+
+def top_frames(stacks, limit=TOP_FRAMES):
+    """Funzioni più presenti: 'self' (in cima allo stack) e 'total' (ovunque nello stack)."""
+    self_counts, total_counts = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        self_counts[frames[-1]] += count
+        for f in set(frames):
+            total_counts[f] += count
+    return {
+        "self": [{"frame": f, "samples": n} for f, n in self_counts.most_common(limit)],
+        "total": [{"frame": f, "samples": n} for f, n in total_counts.most_common(limit)],
+    }
+
+
+class ProfileStore:
+    """Ultimi PROFILER_KEEP profili in memoria (per worker)."""
+    def __init__(self, keep=PROFILER_KEEP):
+        self._items = deque(maxlen=keep)
+        self._lock = threading.Lock()
+
+    def add(self, profile):
+        with self._lock:
+            self._items.append(profile)
+
+    def list(self):
+        with self._lock:
+            return list(reversed(self._items))
+
+    def get(self, profile_id):
+        with self._lock:
+            return next((p for p in self._items if p["id"] == profile_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+sampler = Sampler()
+profile_store = ProfileStore()
+
+
+def should_profile():
+    if request.path.startswith("/admin/") or request.path.endswith("/stream"):
+        return False  # stream SSE: durano minuti e sono quasi solo attesa
+    token = profiler_token()
+    if token and request.headers.get("X-Profile") == token:
+        return True
+    rate = sample_rate()
+    return rate > 0 and random.random() < rate
+
+
+def summary(p):
+    return {k: p[k] for k in ("id", "method", "path", "status", "startedAt", "durationMs", "samples")}
+
+
+def register_profiler(app):
+    @app.before_request
+    def _profile_start():
+        if should_profile():
+            g.profile_started = (time.time(), time.perf_counter())
+            sampler.start(threading.get_ident())
+
+    @app.after_request
+    def _profile_status(response):
+        if "profile_started" in g:
+            g.profile_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _profile_stop(exc):
+        started = g.pop("profile_started", None)
+        if not started:
+            return
+        stacks = sampler.stop(threading.get_ident())
+        profile_store.add({
+            "id": uuid.uuid4().hex[:12],
+            "method": request.method,
+            "path": request.path,
+            "status": g.pop("profile_status", 500),
+            "startedAt": started[0],
+            "durationMs": round((time.perf_counter() - started[1]) * 1000, 1),
+            "intervalMs": PROFILER_INTERVAL_MS,
+            "samples": sum(stacks.values()),
+            "stacks": stacks,
+        })
+
+    def _authorized():
+        token = profiler_token()
+        return bool(token) and request.headers.get("X-Admin-Token") == token
+
+    @app.route('/admin/profiles', methods=['GET', 'DELETE'])
+    def list_profiles():
+        if not _authorized():
+            return jsonify({"success": False, "error": "Not found"}), 404
+        if request.method == 'DELETE':
+            profile_store.clear()
+            return jsonify({"success": True}), 200
+        return jsonify({"success": True, "data": [summary(p) for p in profile_store.list()]}), 200
+
+    @app.route('/admin/profiles/<profile_id>', methods=['GET'])
+    def get_profile_dump(profile_id):
+        """?format=collapsed -> testo per flamegraph.pl / speedscope; altrimenti JSON con le top frame."""
+        if not _authorized():
+            return jsonify({"success": False, "error": "Not found"}), 404
+        p = profile_store.get(profile_id)
+        if not p:
+            return jsonify({"success": False, "error": "Profile not found"}), 404
+        if request.args.get("format") == "collapsed":
+            body = "".join(f"{stack} {count}\n" for stack, count in p["stacks"].most_common())
+            return Response(body, mimetype="text/plain")
+        return jsonify({"success": True, "data": {
+            **summary(p), "intervalMs": p["intervalMs"], "top": top_frames(p["stacks"])
+        }}), 200
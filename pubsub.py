@@ -0,0 +1,188 @@
+import os
+import json
+import uuid
+import time
+import threading
+import itertools
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:  # Windows: niente lock tra processi, il bridge resta utilizzabile in sviluppo
+    fcntl = None
+
+
+class Subscription:
+    """
+    Coda di eventi per un singolo client in ascolto.
+    La coda è limitata: se il client è lento gli eventi più vecchi vengono
+    scartati (backpressure) invece di far crescere la memoria del worker.
+    """
+    def __init__(self, hub, topics, maxsize=100):
+        self.hub = hub
+        self.topics = set(topics)
+        self.queue = deque(maxlen=maxsize)
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def push(self, event):
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(event)
+            self.cond.notify()
+
+    def get(self, timeout=15.0):
+        """Attende fino a 'timeout' secondi e ritorna gli eventi in coda (lista, anche vuota)."""
+        with self.cond:
+            if not self.queue and not self.closed:
+                self.cond.wait(timeout)
+            events = list(self.queue)
+            self.queue.clear()
+            return events
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.hub.unsubscribe(self)
+
+
+class SpoolBridge:
+    """
+    Broker locale tra i worker gunicorn della stessa macchina.
+    Ogni publish viene accodato come riga JSON in un file condiviso; un thread
+    per processo legge le righe nuove e le consegna all'hub locale.
+    Il file viene troncato quando supera max_bytes: i client recuperano
+    eventuali eventi persi dal cursore (last-seen) lato database.
+    """
+    def __init__(self, path, poll_interval=0.2, max_bytes=4 * 1024 * 1024):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.max_bytes = max_bytes
+        self.origin = uuid.uuid4().hex
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def send(self, topic, data):
+        line = json.dumps({"origin": self.origin, "topic": topic, "data": data},
+                          ensure_ascii=False, default=str) + "\n"
+        with open(self.path, "a", encoding="utf-8") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if f.tell() > self.max_bytes:
+                    f.truncate(0)
+                f.write(line)
+                f.flush()
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def start(self, deliver):
+        """Avvia (una sola volta per processo) il thread che inoltra gli eventi degli altri worker."""
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._tail, args=(deliver,), daemon=True, name="pubsub-spool").start()
+
+    def _tail(self, deliver):
+        try:
+            offset = os.path.getsize(self.path)
+        except OSError:
+            offset = 0
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                continue
+            if size < offset:  # file troncato da un altro worker
+                offset = 0
+            if size == offset:
+                continue
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                chunk = f.read()
+            # solo righe complete: una scrittura in corso verrà letta al giro successivo
+            end = chunk.rfind(b"\n") + 1
+            offset += end
+            for line in chunk[:end].splitlines():
+                try:
+                    msg = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    continue
+                if msg.get("origin") != self.origin:
+                    deliver(msg.get("topic"), msg.get("data"))
+
+
+class PubSubHub:
+    """
+    Pub/sub in-process con fan-out per topic (es. 'poll:<id>', 'chat:<thread>').
+    Con un bridge (es. SpoolBridge) gli eventi raggiungono anche gli altri worker.
+    """
+    def __init__(self, bridge=None):
+        self._lock = threading.Lock()
+        self._subs = {}  # topic -> set(Subscription)
+        self._seq = itertools.count(1)
+        self.bridge = bridge
+
+    def subscribe(self, topics, maxsize=100):
+        if self.bridge:
+            # avviato al primo subscribe: i thread non sopravvivono al fork dei worker
+            self.bridge.start(self._deliver)
+        sub = Subscription(self, topics, maxsize)
+        with self._lock:
+            for t in sub.topics:
+                self._subs.setdefault(t, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for t in sub.topics:
+                subs = self._subs.get(t)
+                if subs:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._subs[t]
+
+    def publish(self, topic, data):
+        """Consegna 'data' agli iscritti al topic (e agli altri worker via bridge)."""
+        if self.bridge:
+            try:
+                self.bridge.send(topic, data)
+            except OSError:
+                pass  # il bridge è best-effort: la consegna locale avviene comunque
+        return self._deliver(topic, data)
+
+    def _deliver(self, topic, data):
+        """Consegna locale. Ritorna il numero di destinatari."""
+        event = {"id": next(self._seq), "topic": topic, "data": data}
+        with self._lock:
+            targets = list(self._subs.get(topic, ()))
+        for sub in targets:
+            sub.push(event)
+        return len(targets)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len({s for subs in self._subs.values() for s in subs})
+
+
+def sse_event(data, event=None, event_id=None):
+    """Formatta un messaggio Server-Sent Events."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    lines.extend(f"data: {line}" for line in payload.splitlines())
+    return "\n".join(lines) + "\n\n"
+
+
+def sse_comment(text="keepalive"):
+    """Commento SSE: tiene viva la connessione attraverso proxy e load balancer."""
+    return f": {text}\n\n"
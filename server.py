@@ -1,17 +1,48 @@
-from flask import Flask, request, jsonify
+import time
+_import_started = time.perf_counter()  # tempo di avvio, in /health?verbose=1
+
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import argofamiglia
 import uuid
 import os
+import io
 import json
 import requests
-import secrets
 import re
 import base64
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from urllib.parse import unquote
-from datetime import datetime  # ✅ ADDED IMPORT
+from datetime import datetime, timezone  # ✅ ADDED IMPORT
+from dotenv import load_dotenv
+
+# Prima dei moduli locali: alcuni leggono variabili d'ambiente all'import
+load_dotenv() # Load local .env if present
+
 from planner_routes import register_planner_routes
+from compression import register_compression
+from profiler import register_profiler
+from pubsub import PubSubHub, SpoolBridge, sse_event, sse_comment
+from cache import TTLCache
+from write_behind import WriteBehindBuffer
+from compact import negotiate_payload
+from snapshots import SnapshotStore
+from class_cache import class_cache, class_scope
+from grade_stats import grade_stats
+from calendar_feed import calendar_token, is_valid_token, cached_ics
+from timing import StageTimer
+import avatars
+import db
+
+try:
+    import fcntl
+except ImportError:  # Windows: il lock su polls.json vale solo tra thread
+    fcntl = None
 
 # CREA UNA SOLA ISTANZA DI FLASK
 app = Flask(__name__)
@@ -23,75 +54,81 @@ _allowed = [o.strip() for o in ALLOWED_ORIGINS.split(",") if o.strip()]
 CORS(app,
      resources={r"/*": {"origins": _allowed or ["https://dende197.github.io"]}},
      supports_credentials=True,
-     allow_headers=["Content-Type", "Authorization", "X-Requested-With"],
-     methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
+     allow_headers=["Content-Type", "Authorization", "X-Requested-With",
+                    "If-None-Match", "If-Modified-Since", "If-Match", "Prefer",
+                    "X-Schema-Version", "X-Schema-Layout", "X-Debug-Timing", "X-Profile"],
+     expose_headers=["ETag", "Last-Modified", "Server-Timing"],
+     methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"])
+
+# JSON veloce (orjson se installato) e compressione gzip/brotli delle risposte grandi
+register_compression(app)
+
+# Profiler statistico opt-in (PROFILER_SAMPLE_RATE / header X-Profile), dump in /admin/profiles
+register_profiler(app)
 
 # REGISTRA LE ROUTE DEL PLANNER SULL'ISTANZA 'app'
 register_planner_routes(app)
 
-# ✅ NEW: Supabase
-from supabase import create_client, Client
-from dotenv import load_dotenv
-
-load_dotenv() # Load local .env if present
+# Pub/sub in-process per gli stream SSE (sondaggi, chat).
+# Con più worker gunicorn imposta PUBSUB_SPOOL_FILE (es. /tmp/gconnect-events.log)
+# per inoltrare gli eventi tra processi sulla stessa macchina.
+PUBSUB_SPOOL_FILE = os.environ.get("PUBSUB_SPOOL_FILE")
+event_hub = PubSubHub(bridge=SpoolBridge(PUBSUB_SPOOL_FILE) if PUBSUB_SPOOL_FILE else None)
 
 # ============= DEBUG SUPABASE KEY =============
-print("\n" + "="*70)
-print("🔍 DEBUG: Verifica Supabase Configuration")
-url = os.environ.get("SUPABASE_URL")
-key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-
-if url:
-    print(f"✅ SUPABASE_URL: {url}")
-else:
-    print("❌ SUPABASE_URL: NOT SET")
-
-if key:
-    print(f"✅ SUPABASE_SERVICE_ROLE_KEY presente ({len(key)} caratteri)")
-    print(f"   Primi 50 caratteri: {key[:50]}...")
-    
-    # Decodifica JWT per verificare il ruolo
-    try:
-        import base64
-        import json
-        # Il JWT è formato da 3 parti separate da punti
-        parts = key.split('.')
-        if len(parts) >= 2:
-            # Decodifica la seconda parte (payload)
-            payload_b64 = parts[1]
-            # Aggiungi padding se necessario
-            payload_b64 += '=' * (4 - len(payload_b64) % 4)
-            # Decodifica
-            payload_json = base64.urlsafe_b64decode(payload_b64)
-            payload = json.loads(payload_json)
-            
-            role = payload.get('role', 'UNKNOWN')
-            print(f"   Ruolo decodificato dal JWT: {role}")
-            
-            if role == 'service_role':
-                print("   ✅✅✅ PERFETTO! Stai usando la chiave SERVICE_ROLE")
-            elif role == 'anon':
-                print("   ❌❌❌ ERRORE! Stai usando la chiave ANON (pubblica)")
-                print("   ❌ Devi cambiare con la chiave service_role da Supabase Settings → API")
-            else:
-                print(f"   ⚠️ Ruolo sconosciuto: {role}")
-    except Exception as e:
-        print(f"   ⚠️ Impossibile decodificare JWT: {e}")
-else:
-    print("❌ SUPABASE_SERVICE_ROLE_KEY: NOT SET")
+def debug_supabase_config():
+    """Stampa la configurazione Supabase (ruolo della chiave): eseguita alla creazione del client."""
+    print("\n" + "="*70)
+    print("🔍 DEBUG: Verifica Supabase Configuration")
+    url = os.environ.get("SUPABASE_URL")
+    key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+
+    if url:
+        print(f"✅ SUPABASE_URL: {url}")
+    else:
+        print("❌ SUPABASE_URL: NOT SET")
+
+    if key:
+        print(f"✅ SUPABASE_SERVICE_ROLE_KEY presente ({len(key)} caratteri)")
+        print(f"   Primi 50 caratteri: {key[:50]}...")
 
-print("="*70 + "\n")
+        # Decodifica JWT per verificare il ruolo
+        try:
+            import base64
+            import json
+            # Il JWT è formato da 3 parti separate da punti
+            parts = key.split('.')
+            if len(parts) >= 2:
+                # Decodifica la seconda parte (payload)
+                payload_b64 = parts[1]
+                # Aggiungi padding se necessario
+                payload_b64 += '=' * (4 - len(payload_b64) % 4)
+                # Decodifica
+                payload_json = base64.urlsafe_b64decode(payload_b64)
+                payload = json.loads(payload_json)
+
+                role = payload.get('role', 'UNKNOWN')
+                print(f"   Ruolo decodificato dal JWT: {role}")
+
+                if role == 'service_role':
+                    print("   ✅✅✅ PERFETTO! Stai usando la chiave SERVICE_ROLE")
+                elif role == 'anon':
+                    print("   ❌❌❌ ERRORE! Stai usando la chiave ANON (pubblica)")
+                    print("   ❌ Devi cambiare con la chiave service_role da Supabase Settings → API")
+                else:
+                    print(f"   ⚠️ Ruolo sconosciuto: {role}")
+        except Exception as e:
+            print(f"   ⚠️ Impossibile decodificare JWT: {e}")
+    else:
+        print("❌ SUPABASE_SERVICE_ROLE_KEY: NOT SET")
+
+    print("="*70 + "\n")
 # ============= FINE DEBUG =============
 
 
 # ============= CONSTANTS =============
-CHALLENGE_URL = "https://auth.portaleargo.it/oauth2/auth"
-LOGIN_URL = "https://www.portaleargo.it/auth/sso/login"
-TOKEN_URL = "https://auth.portaleargo.it/oauth2/token"
-REDIRECT_URI = "it.argosoft.didup.famiglia.new://login-callback"
-CLIENT_ID = "72fd6dea-d0ab-4bb9-8eaa-3ac24c84886c"
-ENDPOINT = "https://www.portaleargo.it/appfamiglia/api/rest/"
-USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/106.0.0.0 Safari/537.36"
+# URL e client id del flusso OAuth Argo: in argo_auth.py (condivisi con debug_auth.py)
+from argo_auth import USER_AGENT, oauth_login
 
 
 # ============= CONFIGURAZIONE DEBUG =============
@@ -126,18 +163,26 @@ def debug_log(message, data=None):
         print(f"{'='*60}\n")
 
 # ============= SUPABASE CLIENT =============
-supabase: Client = None
-try:
+# Creato al primo uso (o da warm_up()): il pacchetto supabase e le sue dipendenze
+# pesano più di tutto il resto sull'avvio a freddo. 'if supabase:' funziona come prima.
+def create_supabase_client():
+    from supabase import create_client, ClientOptions
+    debug_supabase_config()
     supabase_url = os.environ.get("SUPABASE_URL")
     supabase_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-    if supabase_url and supabase_key:
-        supabase = create_client(supabase_url, supabase_key)
-        debug_log("✅ Supabase client inizializzato")
-    else:
+    if not (supabase_url and supabase_key):
         debug_log("⚠️ Supabase non configurato (variabili mancanti)")
-except Exception as e:
-    debug_log("❌ Errore inizializzazione Supabase", str(e))
-    supabase = None
+        return None
+    # Pool httpx condiviso: timeout di default, retry sulle letture, tempi per tabella
+    client = create_client(supabase_url, supabase_key,
+                           options=ClientOptions(httpx_client=db.make_supabase_http_client()))
+    debug_log("✅ Supabase client inizializzato")
+    return client
+
+supabase = db.LazyClient(
+    create_supabase_client,
+    on_error=lambda e: debug_log("❌ Errore inizializzazione Supabase", str(e)),
+)
 
 # Regex per validazione classe (1A-5Z)
 CLASS_REGEX = re.compile(r"^[1-5][A-Z]$")
@@ -219,77 +264,10 @@ class AdvancedArgo(argofamiglia.ArgoFamiglia):
         self._ArgoFamiglia__token = auth_token
 
     @staticmethod
-    def raw_login(school, username, password):
+    def raw_login(school, username, password, timer=None):
+        """Login OAuth Argo + profili. 'timer' (StageTimer) raccoglie i tempi di ogni fase."""
         try:
-            CODE_VERIFIER = secrets.token_hex(64)
-            CODE_CHALLENGE = base64.urlsafe_b64encode(
-                sha256(CODE_VERIFIER.encode()).digest()
-            ).decode().replace("=", "")
-            session = requests.Session()
-            params = {
-                "redirect_uri": REDIRECT_URI,
-                "client_id": CLIENT_ID,
-                "response_type": "code",
-                "prompt": "login",
-                "state": secrets.token_urlsafe(32),
-                "scope": "openid offline profile user.roles argo",
-                "code_challenge": CODE_CHALLENGE,
-                "code_challenge_method": "S256"
-            }
-            req = session.get(CHALLENGE_URL, params=params)
-            m = re.search(r"login_challenge=([0-9a-f]+)", req.url)
-            if not m:
-                raise Exception("Login challenge non trovata")
-            login_challenge = m.group(1)
-
-            login_data = {
-                "challenge": login_challenge,
-                "client_id": CLIENT_ID,
-                "prefill": "true",
-                "famiglia_customer_code": school,
-                "username": username,
-                "password": password,
-                "login": "true"
-            }
-            req = session.post(LOGIN_URL, data=login_data, allow_redirects=False)
-            if "Location" not in req.headers:
-                raise ValueError("Credenziali errate o scuola non valida")
-
-            while True:
-                location = req.headers["Location"]
-                if "code=" in location:
-                    break
-                req = session.get(location, allow_redirects=False)
-
-            code_match = re.search(r"code=([0-9a-zA-Z-_.]+)", location)
-            if not code_match:
-                raise Exception("Auth code non trovato")
-            code = code_match.group(1)
-
-            token_req_data = {
-                "code": code,
-                "grant_type": "authorization_code",
-                "redirect_uri": REDIRECT_URI,
-                "code_verifier": CODE_VERIFIER,
-                "client_id": CLIENT_ID
-            }
-            tokens = session.post(TOKEN_URL, data=token_req_data).json()
-            access_token = tokens["access_token"]
-
-            login_headers = {
-                "User-Agent": USER_AGENT,
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + access_token,
-                "Accept": "application/json",
-            }
-            payload = {
-                "clientID": secrets.token_urlsafe(64),
-                "lista-x-auth-token": "[]",
-                "x-auth-token-corrente": "null",
-                "lista-opzioni-notifiche": "{}"
-            }
-            argo_resp = requests.post(ENDPOINT + "login", headers=login_headers, json=payload).json()
-            soggetti = argo_resp.get("data", []) or []
+            access_token, soggetti = oauth_login(school, username, password, timer)
 
             debug_log("🔍 SOGGETTI RICEVUTI", {
                 "count": len(soggetti),
@@ -643,7 +621,14 @@ def strategia_3_metodo_diretto(argo_instance):
 
 
 def extract_grades_multi_strategy(argo_instance):
+    """
+    Voti dalla dashboard o, in mancanza, dagli endpoint REST diretti.
+    Solleva eccezione se nessuna fonte ha risposto: la lista vuota vale
+    "nessun voto", non "Argo non raggiungibile" (lo snapshot resta valido).
+    """
     grades = []
+    answered = False
+    last_error = None
     
     # 1. Dashboard Strategy
     try:
@@ -652,6 +637,9 @@ def extract_grades_multi_strategy(argo_instance):
         dati_list = data_obj.get('dati', []) if isinstance(data_obj, dict) else []
         if not dati_list and 'dati' in dashboard_data:
              dati_list = dashboard_data.get('dati', [])
+        answered = isinstance(dati_list, list) and (
+            'dati' in dashboard_data or (isinstance(data_obj, dict) and 'dati' in data_obj)
+        )
         
         if dati_list:
             main_data = dati_list[0]
@@ -667,14 +655,15 @@ def extract_grades_multi_strategy(argo_instance):
                             "valore": valore,
                             "data": v.get('datGiorno') or v.get('data'),
                             "tipo": v.get('desVoto') or v.get('tipo', 'N/D'),
+                            "peso": v.get('numPeso', '100'),
                             "subject": materia,
                             "value": valore,
                             "date": v.get('datGiorno', ''),
                             "id": str(uuid.uuid4())[:12]
                         })
                     return grades
-    except:
-        pass
+    except Exception as e:
+        last_error = e
         
     # 2. Direct API Strategy (fallback)
     try:
@@ -687,90 +676,154 @@ def extract_grades_multi_strategy(argo_instance):
                 if res.status_code == 200:
                     data = res.json()
                     if isinstance(data, list):
+                        answered = True
                         for v in data:
                             grades.append({
                                 "materia": v.get('desMateria', 'N/D'),
                                 "valore": v.get('codVoto', ''),
                                 "data": v.get('datGiorno', ''),
+                                "peso": v.get('numPeso', '100'),
                                 "subject": v.get('desMateria', 'N/D'),
                                 "value": v.get('codVoto', ''),
                                 "date": v.get('datGiorno', ''),
                                 "id": str(uuid.uuid4())[:12]
                             })
                         if grades: return grades
-            except:
+            except Exception as e:
+                last_error = e
                 continue
-    except:
-        pass
-        
+    except Exception as e:
+        last_error = e
+
+    if not answered:
+        raise last_error or Exception("Voti non disponibili")
     return grades
 
 
 # ============= ESTRAZIONE COMPITI =============
 
-def extract_homework_safe(argo_instance):
+def parse_homework(registro):
+    """Registro Argo -> lista compiti. Id derivati dal contenuto: stabili tra sync e tra compagni."""
+    raw_homework = {}
+    for element in registro:
+         for compito in element.get("compiti", []):
+            data_consegna = compito.get("dataConsegna")
+            if data_consegna not in raw_homework:
+                raw_homework[data_consegna] = {"compiti": [], "materie": []}
+            raw_homework[data_consegna]["compiti"].append(compito.get("compito"))
+            raw_homework[data_consegna]["materie"].append(element.get("materia"))
+
     tasks_data = []
+    seen = set()
+    for date_str, details in raw_homework.items():
+        compiti_list = details.get('compiti', [])
+        materie_list = details.get('materie', [])
+        for i, desc in enumerate(compiti_list):
+            mat = materie_list[i] if i < len(materie_list) else "Generico"
+            task_id = sha256(f"{date_str}|{mat}|{desc}".encode("utf-8")).hexdigest()[:12]
+            if task_id in seen:
+                continue  # stesso compito ripetuto nel registro
+            seen.add(task_id)
+            tasks_data.append({
+                "id": task_id,
+                "text": desc,
+                "subject": mat,
+                "due_date": date_str,
+                "datCompito": date_str,
+                "materia": mat,
+                "done": False
+            })
+    return tasks_data
+
+
+def homework_fingerprint(registro):
+    """Impronta del registro per class_cache: solo i campi letti da parse_homework, in ordine."""
+    return tuple(
+        (element.get("materia"), compito.get("dataConsegna"), compito.get("compito"))
+        for element in registro for compito in element.get("compiti", [])
+    )
+
+
+def extract_homework_safe(argo_instance, scope=None):
+    """
+    Compiti dal registro. Con scope ('codMin:classe') il registro già visto
+    per un compagno di classe non viene rianalizzato (class_cache).
+    Solleva eccezione se Argo non risponde: una lista vuota significa "nessun compito".
+    """
     try:
         dashboard_data = argo_instance.get_full_dashboard()
-        raw_homework = {}
+        registro = []
         if 'data' in dashboard_data and 'dati' in dashboard_data['data']:
             dati = dashboard_data['data']['dati']
             if dati and len(dati) > 0:
                 registro = dati[0].get('registro', [])
-                for element in registro:
-                     for compito in element.get("compiti", []):
-                        data_consegna = compito.get("dataConsegna")
-                        if data_consegna not in raw_homework:
-                            raw_homework[data_consegna] = {"compiti": [], "materie": []}
-                        raw_homework[data_consegna]["compiti"].append(compito.get("compito"))
-                        raw_homework[data_consegna]["materie"].append(element.get("materia"))
-
-        for date_str, details in raw_homework.items():
-            compiti_list = details.get('compiti', [])
-            materie_list = details.get('materie', [])
-            for i, desc in enumerate(compiti_list):
-                mat = materie_list[i] if i < len(materie_list) else "Generico"
-                tasks_data.append({
-                    "id": str(uuid.uuid4())[:12],
-                    "text": desc,
-                    "subject": mat,
-                    "due_date": date_str,
-                    "datCompito": date_str,
-                    "materia": mat,
-                    "done": False
-                })
+        else:
+            raise ValueError("Risposta dashboard senza dati")
+        return class_cache.get_or_parse("homework", scope, registro, parse_homework, homework_fingerprint)
     except Exception as e:
         debug_log(f"⚠️ Errore compiti", str(e))
-    return tasks_data
+        raise
+
+
+def parse_promemoria_item(i):
+    return {
+        "titolo": i.get('desOggetto') or i.get('titolo', 'Avviso'),
+        "testo": i.get('desMessaggio') or i.get('testo') or i.get('desAnnotazioni', ''),
+        "autore": i.get('desMittente', 'Scuola'),
+        "data": i.get('datGiorno') or i.get('data', ''),
+        "url": i.get('urlAllegato', ''),
+        "oggetto": i.get('desOggetto') or i.get('titolo', 'Avviso'),
+        "date": i.get('datGiorno', '')
+    }
 
 
-def extract_promemoria(dashboard_data):
-    """Estrae promemoria dalla dashboard"""
+def promemoria_items(dati_list):
+    return [i for blocco in dati_list for i in blocco.get('bachecaAlunno', []) + blocco.get('promemoria', [])]
+
+
+def promemoria_fingerprint(dati_list):
+    """Impronta degli avvisi per class_cache: solo i campi letti da parse_promemoria_item, in ordine."""
+    return tuple(
+        (i.get('desOggetto'), i.get('titolo'), i.get('desMessaggio'), i.get('testo'),
+         i.get('desAnnotazioni'), i.get('desMittente'), i.get('datGiorno'), i.get('data'),
+         i.get('urlAllegato'))
+        for i in promemoria_items(dati_list)
+    )
+
+
+def parse_promemoria(dati_list):
+    """Avvisi analizzati, senza duplicati (stesso avviso in bacheca e promemoria)."""
     promemoria = []
+    seen = set()
+    for i in promemoria_items(dati_list):
+        item = parse_promemoria_item(i)
+        key = tuple(item.values())
+        if key in seen:
+            continue
+        seen.add(key)
+        promemoria.append(item)
+    return promemoria
+
+
+def extract_promemoria(dashboard_data, scope=None):
+    """
+    Estrae promemoria dalla dashboard. Con scope ('codMin:classe') gli avvisi già
+    visti per un compagno di classe non vengono rianalizzati (class_cache).
+    Solleva eccezione se la risposta non è una dashboard valida.
+    """
     try:
+        if not isinstance(dashboard_data, dict) or not ('data' in dashboard_data or 'dati' in dashboard_data):
+            raise ValueError("Risposta dashboard senza dati")
         data_obj = dashboard_data.get('data', {})
         dati_list = data_obj.get('dati', []) if isinstance(data_obj, dict) else []
         
         if not dati_list and 'dati' in dashboard_data:
             dati_list = dashboard_data.get('dati', [])
 
-        for blocco in dati_list:
-            items = blocco.get('bachecaAlunno', []) + blocco.get('promemoria', [])
-            
-            for i in items:
-                promemoria.append({
-                    "titolo": i.get('desOggetto') or i.get('titolo', 'Avviso'),
-                    "testo": i.get('desMessaggio') or i.get('testo') or i.get('desAnnotazioni', ''),
-                    "autore": i.get('desMittente', 'Scuola'),
-                    "data": i.get('datGiorno') or i.get('data', ''),
-                    "url": i.get('urlAllegato', ''),
-                    "oggetto": i.get('desOggetto') or i.get('titolo', 'Avviso'),
-                    "date": i.get('datGiorno', '')
-                })
+        return class_cache.get_or_parse("promemoria", scope, dati_list, parse_promemoria, promemoria_fingerprint)
     except Exception as e:
         debug_log(f"⚠️ Errore promemoria", str(e))
-    
-    return promemoria
+        raise
 
 # --- Student identity via official Argo endpoints ---
 def fetch_student_identity(argo_instance):
@@ -850,55 +903,182 @@ def create_session(school, user, password, access_token, auth_token):
 
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({"status": "ok", "debug": DEBUG_MODE}), 200
+    body = {"status": "ok", "debug": DEBUG_MODE}
+    if request.args.get("verbose"):
+        # Tempi delle chiamate a Supabase per tabella/operazione e delle fasi Argo (dall'avvio del processo)
+        body["db"] = db.stats()
+        body["classCache"] = class_cache.stats()
+        body["sseStreams"] = {"open": sse_streams["open"], "max": SSE_MAX_STREAMS}
+        body["startup"] = {"importSeconds": STARTUP_SECONDS, "supabaseInitSeconds": supabase.init_seconds}
+    return jsonify(body), 200
 
 # ============= AVATAR & PROFILE ENDPOINTS =============
 
+# Cache condivisa dei profili (id -> campi proiettati, None = profilo inesistente).
+# TTL breve: update_profile() invalida subito, le modifiche da altri worker
+# diventano visibili al massimo dopo PROFILE_CACHE_TTL secondi.
+PROFILE_COLUMNS = "id,name,class,avatar,last_active"
+PROFILE_CACHE_TTL = int(os.environ.get("PROFILE_CACHE_TTL", "60"))
+PROFILE_BATCH_MAX_IDS = 500
+PROFILE_QUERY_CHUNK = 100  # id per singola query in.(...), per non superare la lunghezza URL
+profile_cache = TTLCache(maxsize=5000, ttl=PROFILE_CACHE_TTL)
+
+def fetch_profiles(ids):
+    """Profili per una lista di id: cache prima, poi una query in.(...) per blocco. Ritorna {id: profilo}."""
+    found, missing = profile_cache.get_many(ids)
+    for i in range(0, len(missing), PROFILE_QUERY_CHUNK):
+        chunk = missing[i:i + PROFILE_QUERY_CHUNK]
+        resp = supabase.table("profiles").select(PROFILE_COLUMNS).in_("id", chunk).execute()
+        rows = {r.get("id"): r for r in (resp.data or [])}
+        for pid in chunk:
+            profile_cache.set(pid, rows.get(pid))
+            found[pid] = rows.get(pid)
+    return {pid: p for pid, p in found.items() if p}
+
+def invalidate_profile(pid):
+    profile_cache.pop(pid)
+
+# last_active non richiede una scrittura sincrona: gli aggiornamenti vengono
+# accorpati per id e scritti con un unico upsert ogni PROFILE_FLUSH_SECONDS.
+PROFILE_FLUSH_SECONDS = float(os.environ.get("PROFILE_FLUSH_SECONDS", "10"))
+
+def _flush_profile_updates(rows):
+    if supabase:
+        supabase.table("profiles").upsert(rows, on_conflict="id").execute()
+        debug_log("👤 Profile write-behind flush", {"rows": len(rows)})
+
+profile_writes = WriteBehindBuffer(
+    _flush_profile_updates,
+    interval=PROFILE_FLUSH_SECONDS,
+    max_pending=200,
+    on_error=lambda e: debug_log("⚠️ Profile write-behind flush error", str(e)),
+)
+# Ultima identità (nome/classe) scritta per profilo: se invariata basta il write-behind
+written_identity = TTLCache(maxsize=10000, ttl=3600)
+
+def touch_profile(pid, name=None, cls=None):
+    """
+    Aggiorna last_active del profilo. Nome e classe vengono scritti subito solo
+    se diversi dall'ultima scrittura nota, altrimenti l'aggiornamento è differito.
+    """
+    now = datetime.now().isoformat()
+    identity = {k: v for k, v in (("name", name), ("class", cls)) if v}
+    known = written_identity.get(pid) or {}
+    if any(known.get(k) != v for k, v in identity.items()):
+        supabase.table("profiles").upsert({"id": pid, **identity, "last_active": now}, on_conflict="id").execute()
+        profile_writes.discard(pid)
+        written_identity.set(pid, {**known, **identity})
+        invalidate_profile(pid)
+        return True
+    profile_writes.put(pid, {"id": pid, "last_active": now})
+    return False
+
+# Margine per boundary e header di un multipart con un solo file
+MULTIPART_OVERHEAD_BYTES = 16 * 1024
+
+def read_avatar_upload():
+    """
+    Estrae (user_id, file, size, mime_type) dalla richiesta di upload.
+    Il file è sempre bufferizzato su disco oltre una piccola soglia, mai copiato
+    interamente in memoria; la dimensione massima è verificata prima di leggere.
+    """
+    content_type = (request.mimetype or "").lower()
+    declared = request.content_length
+
+    # 1) multipart/form-data: campo 'image' (+ 'userId')
+    if content_type == "multipart/form-data":
+        if declared is None:
+            raise ValueError("Content-Length richiesto")
+        if declared > avatars.AVATAR_MAX_BYTES + MULTIPART_OVERHEAD_BYTES:
+            raise avatars.UploadTooLarge("Immagine troppo grande")
+        upload = request.files.get("image")  # werkzeug: file temporaneo, non RAM
+        if not upload:
+            raise ValueError("Campo 'image' mancante")
+        size = avatars.file_size(upload.stream)
+        if size > avatars.AVATAR_MAX_BYTES:
+            raise avatars.UploadTooLarge("Immagine troppo grande")
+        user_id = request.form.get("userId") or str(uuid.uuid4())
+        return user_id, upload.stream, size, (upload.mimetype or "").lower()
+
+    # 2) corpo binario grezzo: Content-Type: image/png, ?userId=...
+    if content_type.startswith("image/"):
+        if declared is not None and declared > avatars.AVATAR_MAX_BYTES:
+            raise avatars.UploadTooLarge("Immagine troppo grande")
+        spool, size = avatars.spool_stream(request.stream)
+        user_id = request.args.get("userId") or str(uuid.uuid4())
+        return user_id, spool, size, content_type
+
+    # 3) legacy JSON: { "image": "data:image/png;base64,...", "userId": "..." }
+    if declared is not None and declared > avatars.AVATAR_MAX_BYTES * 4 // 3 + MULTIPART_OVERHEAD_BYTES:
+        raise avatars.UploadTooLarge("Immagine troppo grande")
+    payload = request.json or {}
+    base64_image = payload.get('image', '')
+    if not base64_image or not base64_image.startswith('data:image/'):
+        raise ValueError("Formato immagine non valido")
+    header, encoded = base64_image.split(',', 1)
+    mime_type = header.split(';')[0].split(':')[1].lower()
+    image_bytes = base64.b64decode(encoded)
+    return payload.get('userId', str(uuid.uuid4())), io.BytesIO(image_bytes), len(image_bytes), mime_type
+
 @app.route('/api/upload', methods=['POST'])
 def upload_avatar():
     """
     Carica un'immagine avatar su Supabase Storage e restituisce l'URL pubblico.
-    Request: { "image": "data:image/png;base64,iVBORw0...", "userId": "user_id" }
-    Response: { "success": true, "url": "https://...supabase.co/.../avatars/file.png" }
+    Formati accettati:
+      - multipart/form-data con campi 'image' (file) e 'userId'
+      - corpo binario con Content-Type: image/* e ?userId=...
+      - JSON legacy: { "image": "data:image/png;base64,iVBORw0...", "userId": "user_id" }
+    Response: { "success": true, "url": "<variante 128px>", "original": "<originale>",
+                "variants": { "64": "...", "128": "...", "512": "..." } }
     """
     if not supabase:
         return jsonify({"success": False, "error": "Supabase non configurato"}), 500
     
     try:
-        payload = request.json or {}
-        base64_image = payload.get('image', '')
-        user_id = payload.get('userId', str(uuid.uuid4()))
-        
-        if not base64_image or not base64_image.startswith('data:image/'):
+        user_id, image_file, size, mime_type = read_avatar_upload()
+    except avatars.UploadTooLarge as e:
+        return jsonify({"success": False, "error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    try:
+        file_extension = avatars.AVATAR_TYPES.get(mime_type)
+        if not file_extension:
             return jsonify({"success": False, "error": "Formato immagine non valido"}), 400
         
-        # Estrai MIME type e dati
-        header, encoded = base64_image.split(',', 1)
-        mime_type = header.split(';')[0].split(':')[1]
-        file_extension = mime_type.split('/')[1]
-        
-        # Decodifica base64
-        image_bytes = base64.b64decode(encoded)
-        
-        # Nome file unico
-        filename = f"{user_id.replace(':', '_')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{file_extension}"
-        
-        # Upload su Supabase Storage (bucket: avatars)
-        supabase.storage.from_('avatars').upload(
-            path=filename,
-            file=image_bytes,
-            file_options={"content-type": mime_type, "upsert": "true"}
-        )
-        
-        # Ottieni URL pubblico
-        public_url = supabase.storage.from_('avatars').get_public_url(filename)
+        # Nome content-addressed: stessa immagine -> stesso oggetto e stesso URL
+        base_name = avatars.content_hash(image_file)[:32]
+        filename = f"{base_name}.{file_extension}"
+
+        if avatars.object_exists(filename):
+            # Già caricata (l'originale è scritto per ultimo): si riusano le varianti
+            # davvero presenti; se mancano tutte (Pillow assente o fallito al primo
+            # upload) si prova a rigenerarle, altrimenti resta l'originale
+            original_url = avatars.public_url(filename)
+            variants = avatars.stored_variants(base_name)
+            if not variants and avatars.Image is not None:
+                variants = avatars.upload_variants(base_name, image_file)
+            deduplicated = True
+        else:
+            # Varianti ridimensionate, poi l'originale in streaming (bucket: avatars)
+            variants = avatars.upload_variants(base_name, image_file)
+            original_url = avatars.upload_object(filename, image_file, mime_type, size)
+            deduplicated = False
+
+        # 'url' = variante piccola per feed/chat (l'originale resta disponibile)
+        public_url = variants.get(str(avatars.AVATAR_DEFAULT_VARIANT), original_url)
         
-        debug_log(f"✅ Avatar uploaded: {filename}", {"url": public_url})
-        return jsonify({"success": True, "url": public_url}), 200
+        debug_log(f"✅ Avatar uploaded: {filename}", {
+            "user": user_id, "url": public_url, "bytes": size,
+            "variants": list(variants), "deduplicated": deduplicated
+        })
+        return jsonify({"success": True, "url": public_url, "original": original_url, "variants": variants}), 200
         
     except Exception as e:
         debug_log("❌ Avatar upload failed", str(e))
         return jsonify({"success": False, "error": str(e)}), 500
+    finally:
+        image_file.close()
 
 
 @app.route('/api/profile', methods=['PUT'])
@@ -917,6 +1097,11 @@ def update_profile():
         if not user_id:
             return jsonify({"success": False, "error": "userId mancante"}), 400
         
+        if not any(k in payload for k in ('name', 'class', 'avatar')):
+            # Solo "sono attivo": nessuna modifica reale, scrittura differita
+            touch_profile(user_id)
+            return jsonify({"success": True}), 200
+
         profile_data = {
             "id": user_id,  # ✅ Fixed: Table uses 'id'
             "last_active": datetime.now().isoformat()
@@ -934,6 +1119,9 @@ def update_profile():
         
         # ✅ Fixed: Explicit on_conflict for upsert
         supabase.table("profiles").upsert(profile_data, on_conflict="id").execute()
+        profile_writes.discard(user_id)
+        written_identity.pop(user_id)
+        invalidate_profile(user_id)
         debug_log(f"✅ Profile updated: {user_id}")
         return jsonify({"success": True}), 200
         
@@ -952,13 +1140,10 @@ def get_profile(user_id):
         return jsonify({"success": False, "error": "Supabase non configurato"}), 500
     
     try:
-        # ✅ Fixed: Table uses 'id'
-        result = supabase.table("profiles").select("*").eq("id", user_id).execute()
-        
-        if not result.data or len(result.data) == 0:
+        profile = fetch_profiles([user_id]).get(user_id)
+        if not profile:
             return jsonify({"success": False, "error": "Profilo non trovato"}), 404
-        
-        profile = result.data[0]
+
         debug_log(f"✅ Profile retrieved: {user_id}", {"hasAvatar": bool(profile.get('avatar'))})
         return jsonify({"success": True, "data": profile}), 200
         
@@ -967,16 +1152,67 @@ def get_profile(user_id):
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+@app.route('/api/profiles', methods=['GET', 'POST'])
+def get_profiles_batch():
+    """
+    Profili di più utenti in una sola richiesta (feed, chat).
+    GET ?ids=a,b,c  oppure  POST { "ids": ["a", "b", ...] } per liste lunghe.
+    Response: { "success": true, "data": { "<id>": { "id", "name", "class", "avatar", "last_active" } } }
+    Gli id non trovati sono semplicemente assenti da 'data'.
+    """
+    if not supabase:
+        return jsonify({"success": False, "error": "Supabase non configurato"}), 500
+
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        ids = body.get("ids") if isinstance(body, dict) else None
+        if not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
+            return jsonify({"success": False, "error": "ids deve essere una lista di stringhe"}), 400
+    else:
+        ids = (request.args.get("ids") or "").split(",")
+    # dedup mantenendo l'ordine
+    ids = list(dict.fromkeys(i.strip() for i in ids if i.strip()))
+    if not ids:
+        return jsonify({"success": False, "error": "ids mancanti"}), 400
+    if len(ids) > PROFILE_BATCH_MAX_IDS:
+        return jsonify({"success": False, "error": f"Massimo {PROFILE_BATCH_MAX_IDS} id per richiesta"}), 400
+
+    try:
+        return jsonify({"success": True, "data": fetch_profiles(ids)}), 200
+    except Exception as e:
+        debug_log("❌ Batch profile retrieval failed", str(e))
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
 # ============= PERSISTENCE ENDPOINTS =============
 
+# likes e comments sono letti da normalizePost nel client (index.html)
+POST_COLUMNS = "id,author_id,author_name,class,text,image,anon,likes,comments,created_at"
+POSTGRES_UNDEFINED_COLUMN = "42703"
+# Colonne effettivamente selezionate: se la tabella 'posts' di un'installazione non ha
+# una delle colonne di POST_COLUMNS si ripiega (una volta per processo) su '*'
+post_select = {"columns": POST_COLUMNS}
+
+def fetch_recent_posts(limit=100):
+    columns = post_select["columns"]
+    try:
+        resp = supabase.table("posts").select(columns).order("created_at", desc=True).limit(limit).execute()
+    except Exception as e:
+        if columns == "*" or getattr(e, "code", None) != POSTGRES_UNDEFINED_COLUMN:
+            raise
+        debug_log("⚠️ posts: colonne mancanti nella proiezione, uso select('*')", str(e))
+        post_select["columns"] = "*"
+        resp = supabase.table("posts").select("*").order("created_at", desc=True).limit(limit).execute()
+    return resp.data or []
+MARKET_COLUMNS = "id,seller_id,seller_name,title,price,image,created_at"
+
 @app.route('/api/posts', methods=['GET', 'POST'])
 def handle_posts():
     # Supabase mode
     if supabase:
         if request.method == 'GET':
             try:
-                resp = supabase.table("posts").select("*").order("created_at", desc=True).limit(100).execute()
-                return jsonify({"success": True, "data": resp.data or []}), 200
+                return jsonify({"success": True, "data": fetch_recent_posts()}), 200
             except Exception as e:
                 debug_log("⚠️ /api/posts GET (Supabase) error, falling back", str(e))
                 # Fall through to JSON fallback
@@ -994,8 +1230,7 @@ def handle_posts():
                     "anon": bool(new_post.get("anon", False)),
                 }
                 supabase.table("posts").insert(payload).execute()
-                resp = supabase.table("posts").select("*").order("created_at", desc=True).limit(100).execute()
-                return jsonify({"success": True, "data": resp.data or []}), 200
+                return jsonify({"success": True, "data": fetch_recent_posts()}), 200
             except Exception as e:
                 debug_log("⚠️ /api/posts POST (Supabase) error, falling back", str(e))
                 # Fall through to JSON fallback
@@ -1024,7 +1259,7 @@ def handle_market():
     if supabase:
         if request.method == 'GET':
             try:
-                resp = supabase.table("market_items").select("*").order("created_at", desc=True).limit(200).execute()
+                resp = supabase.table("market_items").select(MARKET_COLUMNS).order("created_at", desc=True).limit(200).execute()
                 return jsonify({"success": True, "data": resp.data or []}), 200
             except Exception as e:
                 debug_log("⚠️ /api/market GET (Supabase) error, falling back", str(e))
@@ -1042,7 +1277,7 @@ def handle_market():
                     "image": new_item.get("image"),
                 }
                 supabase.table("market_items").insert(payload).execute()
-                resp = supabase.table("market_items").select("*").order("created_at", desc=True).limit(200).execute()
+                resp = supabase.table("market_items").select(MARKET_COLUMNS).order("created_at", desc=True).limit(200).execute()
                 return jsonify({"success": True, "data": resp.data or []}), 200
             except Exception as e:
                 debug_log("⚠️ /api/market POST (Supabase) error, falling back", str(e))
@@ -1067,6 +1302,21 @@ def handle_market():
 
 # ============= POLLS ENDPOINTS =============
 POLLS_FILE = "polls.json"
+POLLS_LOCK_FILE = POLLS_FILE + ".lock"
+# Più thread e più worker gunicorn modificano i sondaggi insieme:
+# lettura-modifica-scrittura del file serializzata tra thread e tra processi (flock)
+polls_file_lock = threading.Lock()
+
+@contextmanager
+def polls_file_locked():
+    with polls_file_lock, open(POLLS_LOCK_FILE, "a") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
 
 def load_polls_file():
     try:
@@ -1079,8 +1329,11 @@ def load_polls_file():
 
 def save_polls_file(polls):
     try:
-        with open(POLLS_FILE, 'w', encoding='utf-8') as f:
+        # scrittura atomica: chi legge in parallelo non vede mai un file a metà
+        tmp = f"{POLLS_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
             json.dump(polls, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, POLLS_FILE)
     except Exception as e:
         debug_log("⚠️ save_polls_file error", str(e))
 
@@ -1088,18 +1341,116 @@ def getUserIdFromBody(body):
     """Estrae l'id utente da vari possibili campi nel payload"""
     return body.get("voterId") or body.get("authorId") or body.get("userId") or body.get("voter")
 
+# Colonne per la lista sondaggi: di 'voters' si legge solo la voce del richiedente (my_vote)
+POLL_LIST_COLUMNS = "id,question,choices,author,created_at,expires_at"
+POLLS_PAGE_SIZE = 20
+POLLS_MAX_PAGE_SIZE = 100
+
+def parse_poll_expiry(value):
+    """Converte expires_at (ISO, anche con 'Z') in datetime aware. None se assente/non valido."""
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.astimezone()  # naive = ora locale del server (come created_at)
+    return dt
+
+def is_poll_expired(poll, now=None):
+    expires = parse_poll_expiry(poll.get("expires_at"))
+    return bool(expires and expires <= (now or datetime.now(timezone.utc)))
+
+def compact_poll(poll, voter=None):
+    """
+    Proiezione leggera di un sondaggio: niente mappa 'voters' (cresce con i voti
+    e rivela chi ha votato cosa), solo i conteggi e il voto dell'utente richiedente.
+    """
+    if "my_vote" in poll:
+        my_vote = poll.get("my_vote")  # già estratto dal database (list_active_polls)
+    else:
+        my_vote = (poll.get("voters") or {}).get(voter) if voter else None
+    choices = [
+        {"id": c.get("id"), "text": c.get("text"), "votes": c.get("votes") or 0}
+        for c in (poll.get("choices") or [])
+    ]
+    return {
+        "id": poll.get("id"),
+        "question": poll.get("question"),
+        "choices": choices,
+        "totalVotes": sum(c["votes"] for c in choices),
+        "myVote": my_vote,
+        "author": poll.get("author"),
+        "created_at": poll.get("created_at"),
+        "expires_at": poll.get("expires_at"),
+    }
+
+def parse_page_args(args, default_limit, max_limit):
+    """Legge ?limit=&offset= con valori di default e tetto massimo."""
+    try:
+        limit = int(args.get("limit", default_limit))
+    except (TypeError, ValueError):
+        limit = default_limit
+    try:
+        offset = int(args.get("offset", 0))
+    except (TypeError, ValueError):
+        offset = 0
+    return max(1, min(limit, max_limit)), max(0, offset)
+
+# Id votante usabile come chiave JSON nella select PostgREST (es. 'SG12345:mario.rossi:0')
+VOTER_ID_RE = re.compile(r"^[\w.:@-]{1,128}$")
+
+def my_vote_column(voter):
+    """Solo la voce del votante dalla mappa 'voters' (voters->>id), non la mappa intera."""
+    if not voter or not VOTER_ID_RE.match(voter):
+        return None
+    return f'my_vote:voters->>"{voter}"'
+
+def list_active_polls(voter=None, limit=POLLS_PAGE_SIZE, offset=0):
+    """
+    Pagina di sondaggi non scaduti (più recenti prima) in forma compatta.
+    Ritorna (polls, has_more).
+    """
+    now = datetime.now(timezone.utc)
+    rows = None
+    if supabase:
+        try:
+            my_vote = my_vote_column(voter)
+            columns = POLL_LIST_COLUMNS + (f",{my_vote}" if my_vote else "")
+            resp = (
+                supabase.table("polls")
+                .select(columns)
+                .or_(f"expires_at.is.null,expires_at.gt.{now.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+                .order("created_at", desc=True)
+                .range(offset, offset + limit)  # una riga in più per has_more
+                .execute()
+            )
+            rows = resp.data or []
+        except Exception as e:
+            debug_log("⚠️ /api/polls GET supabase error", str(e))
+
+    if rows is None:
+        active = [p for p in load_polls_file() if not is_poll_expired(p, now)]
+        rows = active[offset:offset + limit + 1]
+
+    has_more = len(rows) > limit
+    polls = [compact_poll(p, voter) for p in rows[:limit] if not is_poll_expired(p, now)]
+    return polls, has_more
+
 @app.route('/api/polls', methods=['GET', 'POST'])
 def handle_polls():
-    # GET: list polls
+    # GET: lista compatta e paginata dei sondaggi attivi
+    # Query: ?userId=...&limit=20&offset=0
     if request.method == 'GET':
-        if supabase:
-            try:
-                resp = supabase.table("polls").select("*").order("created_at", desc=True).execute()
-                return jsonify({"success": True, "data": resp.data or []}), 200
-            except Exception as e:
-                debug_log("⚠️ /api/polls GET supabase error", str(e))
-        polls = load_polls_file()
-        return jsonify({"success": True, "data": polls}), 200
+        voter = getUserIdFromBody(request.args)
+        limit, offset = parse_page_args(request.args, POLLS_PAGE_SIZE, POLLS_MAX_PAGE_SIZE)
+        polls, has_more = list_active_polls(voter, limit, offset)
+        return jsonify({
+            "success": True,
+            "data": polls,
+            "pagination": {"limit": limit, "offset": offset, "hasMore": has_more}
+        }), 200
 
     # POST: create poll
     payload = request.json or {}
@@ -1120,19 +1471,111 @@ def handle_polls():
         "expires_at": expires_at
     }
 
+    saved = False
     if supabase:
         try:
             supabase.table("polls").insert(new_poll).execute()
-            resp = supabase.table("polls").select("*").order("created_at", desc=True).limit(10).execute()
-            return jsonify({"success": True, "data": resp.data or []}), 200
+            saved = True
         except Exception as e:
             debug_log("⚠️ /api/polls POST supabase error", str(e))
 
-    polls = load_polls_file()
-    polls.insert(0, new_poll)
-    save_polls_file(polls)
+    if not saved:
+        with polls_file_locked():
+            polls = load_polls_file()
+            polls.insert(0, new_poll)
+            save_polls_file(polls)
+
+    polls, _ = list_active_polls(author, POLLS_PAGE_SIZE, 0)
     return jsonify({"success": True, "data": polls}), 200
 
+def apply_vote(poll, voter, choice_id):
+    """
+    Applica il voto (o il cambio di voto) al sondaggio, in place.
+    Ritorna i conteggi delle sole opzioni modificate: {choiceId: votes}.
+    """
+    voters = poll.get("voters") or {}
+    prev_choice = voters.get(voter)
+    changed = {}
+    for ch in poll.get("choices", []):
+        if ch["id"] == choice_id:
+            ch["votes"] = (ch.get("votes") or 0) + 1
+            changed[ch["id"]] = ch["votes"]
+        if prev_choice and ch["id"] == prev_choice:
+            ch["votes"] = max(0, (ch.get("votes") or 0) - 1)
+            changed[ch["id"]] = ch["votes"]
+    voters[voter] = choice_id
+    poll["voters"] = voters
+    return changed
+
+def publish_poll_tally(poll, changed):
+    """Notifica agli stream SSE la variazione dei conteggi di un sondaggio."""
+    event_hub.publish(f"poll:{poll.get('id')}", {
+        "pollId": poll.get("id"),
+        "tallies": changed,
+        "totalVotes": sum(c.get("votes") or 0 for c in poll.get("choices", [])),
+    })
+
+POLL_VOTE_CAS_RETRIES = 5
+# False dopo il primo "funzione inesistente": POLL_VOTE.sql non è stato applicato
+poll_vote_rpc = {"available": True}
+POSTGREST_UNKNOWN_FUNCTION = "PGRST202"
+
+def vote_poll_supabase(poll_id, voter, choice_id):
+    """
+    Voto atomico su Supabase, anche con più worker. Ritorna (poll, changed),
+    (None, None) se il sondaggio non esiste.
+    - con la funzione poll_vote (POLL_VOTE.sql): una transazione con lock di riga
+    - senza: lettura-modifica-scrittura con compare-and-swap su 'choices' e 'voters'
+    """
+    if poll_vote_rpc["available"]:
+        try:
+            row = supabase.rpc("poll_vote", {"p_poll_id": poll_id, "p_voter": voter, "p_choice": choice_id}).execute().data
+            if isinstance(row, list):
+                row = row[0] if row else None
+            if not row:
+                return None, None
+            previous = row.pop("previous", None)
+            poll = {**row, "voters": {voter: choice_id}}
+            changed = {} if previous == choice_id else {
+                c.get("id"): c.get("votes") or 0
+                for c in poll.get("choices") or [] if c.get("id") in (choice_id, previous)
+            }
+            return poll, changed
+        except Exception as e:
+            if getattr(e, "code", None) != POSTGREST_UNKNOWN_FUNCTION:
+                raise
+            poll_vote_rpc["available"] = False
+            debug_log("⚠️ poll_vote RPC assente (applica POLL_VOTE.sql), uso compare-and-swap", str(e))
+
+    for _ in range(POLL_VOTE_CAS_RETRIES):
+        rows = supabase.table("polls").select(POLL_LIST_COLUMNS + ",voters").eq("id", poll_id).limit(1).execute().data or []
+        if not rows:
+            return None, None
+        poll = rows[0]
+        if (poll.get("voters") or {}).get(voter) == choice_id:
+            return poll, {}
+        base_choices = json.dumps(poll.get("choices") or [], ensure_ascii=False)
+        # serializzati prima di apply_vote, che modifica 'voters' in place
+        base_voters = None if poll.get("voters") is None else json.dumps(poll["voters"], ensure_ascii=False)
+        changed = apply_vote(poll, voter, choice_id)
+        # Scrive solo se nessuno ha votato dopo la lettura (jsonb: uguaglianza semantica).
+        # I soli conteggi non bastano: due cambi opposti (A->B e B->A) li lasciano
+        # identici e il secondo voto cancellerebbe il primo dalla mappa 'voters'
+        query = (
+            supabase.table("polls")
+            .update({"choices": poll["choices"], "voters": poll["voters"]})
+            .eq("id", poll_id)
+            .eq("choices", base_choices)
+        )
+        if base_voters is None:
+            query = query.is_("voters", "null")
+        else:
+            query = query.eq("voters", base_voters)
+        written = query.execute().data
+        if written:
+            return poll, changed
+    raise RuntimeError("Conflitto di scrittura sul sondaggio, riprova")
+
 @app.route('/api/polls/<poll_id>/vote', methods=['POST'])
 def vote_poll(poll_id):
     body = request.json or {}
@@ -1143,69 +1586,253 @@ def vote_poll(poll_id):
 
     if supabase:
         try:
-            resp = supabase.table("polls").select("*").eq("id", poll_id).limit(1).execute()
-            rows = resp.data or []
-            if not rows:
+            poll, changed = vote_poll_supabase(poll_id, voter, choice_id)
+            if poll is None:
                 return jsonify({"success": False, "error": "Poll not found"}), 404
-            poll = rows[0]
-            voters = poll.get("voters") or {}
-            prev_choice = voters.get(voter)
-            if prev_choice == choice_id:
-                return jsonify({"success": True, "data": poll}), 200
-            choices = poll.get("choices", [])
-            for ch in choices:
-                if ch["id"] == choice_id:
-                    ch["votes"] = (ch.get("votes") or 0) + 1
-                if prev_choice and ch["id"] == prev_choice:
-                    ch["votes"] = max(0, (ch.get("votes") or 0) - 1)
-            voters[voter] = choice_id
-            supabase.table("polls").update({"choices": choices, "voters": voters}).eq("id", poll_id).execute()
-            resp = supabase.table("polls").select("*").eq("id", poll_id).limit(1).execute()
-            return jsonify({"success": True, "data": (resp.data or [])[0]}), 200
+            if changed:
+                publish_poll_tally(poll, changed)
+            return jsonify({"success": True, "data": compact_poll(poll, voter)}), 200
         except Exception as e:
             debug_log("⚠️ /api/polls vote supabase error", str(e))
 
-    polls = load_polls_file()
-    poll = next((p for p in polls if p["id"] == poll_id), None)
-    if not poll:
-        return jsonify({"success": False, "error": "Poll not found"}), 404
-    voters = poll.get("voters", {})
-    prev_choice = voters.get(voter)
-    if prev_choice == choice_id:
-        return jsonify({"success": True, "data": poll}), 200
-    for ch in poll.get("choices", []):
-        if ch["id"] == choice_id:
-            ch["votes"] = ch.get("votes", 0) + 1
-        if prev_choice and ch["id"] == prev_choice:
-            ch["votes"] = max(0, ch.get("votes", 0) - 1)
-    voters[voter] = choice_id
-    poll["voters"] = voters
-    save_polls_file(polls)
-    return jsonify({"success": True, "data": poll}), 200
+    with polls_file_locked():
+        polls = load_polls_file()
+        poll = next((p for p in polls if p["id"] == poll_id), None)
+        if not poll:
+            return jsonify({"success": False, "error": "Poll not found"}), 404
+        if (poll.get("voters") or {}).get(voter) == choice_id:
+            return jsonify({"success": True, "data": compact_poll(poll, voter)}), 200
+        changed = apply_vote(poll, voter, choice_id)
+        save_polls_file(polls)
+    publish_poll_tally(poll, changed)
+    return jsonify({"success": True, "data": compact_poll(poll, voter)}), 200
+
+SSE_KEEPALIVE_SECONDS = 15
+SSE_MAX_STREAM_SECONDS = 300  # il client si riconnette: i worker non restano occupati all'infinito
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+POLL_STREAM_MAX_IDS = 50
+
+def default_sse_max_streams():
+    """
+    Stream SSE aperti per worker. Con gthread ogni stream occupa un thread fino a
+    SSE_MAX_STREAM_SECONDS: al massimo un quarto dei thread, il resto resta alle API.
+    Con gevent gli stream costano un greenlet: metà delle connessioni del worker.
+    """
+    if os.getenv("GUNICORN_WORKER_CLASS", "gthread") == "gevent":
+        return max(1, int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500")) // 2)
+    return max(1, int(os.getenv("GUNICORN_THREADS", "64")) // 4)
+
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS") or default_sse_max_streams())
+SSE_BUSY_RETRY_SECONDS = 30
+sse_streams = {"open": 0}
+sse_streams_lock = threading.Lock()
+
+def acquire_sse_slot():
+    with sse_streams_lock:
+        if sse_streams["open"] >= SSE_MAX_STREAMS:
+            return False
+        sse_streams["open"] += 1
+        return True
+
+def release_sse_slot():
+    with sse_streams_lock:
+        sse_streams["open"] = max(0, sse_streams["open"] - 1)
+
+def sse_response(stream):
+    """
+    Risposta SSE che occupa uno dei SSE_MAX_STREAMS posti del worker, liberato alla
+    chiusura della risposta (anche se il generatore non parte mai).
+    Posti esauriti: 503 con Retry-After e 'retry:', il client riprova più tardi.
+    """
+    if not acquire_sse_slot():
+        stream.close()
+        debug_log("⚠️ SSE: troppi stream aperti nel worker", {"max": SSE_MAX_STREAMS})
+        return Response(
+            f"retry: {SSE_BUSY_RETRY_SECONDS * 1000}\n\n", status=503, mimetype="text/event-stream",
+            headers={**SSE_HEADERS, "Retry-After": str(SSE_BUSY_RETRY_SECONDS)}
+        )
+    response = Response(stream, mimetype="text/event-stream", headers=SSE_HEADERS)
+    response.call_on_close(release_sse_slot)
+    return response
+
+@app.route('/api/polls/stream', methods=['GET'])
+def stream_polls():
+    """
+    Stream SSE con le variazioni dei conteggi per i sondaggi osservati.
+    Query: ?ids=pollA,pollB
+    Evento 'tally': { "pollId": "...", "tallies": {"choiceId": 12}, "totalVotes": 30 }
+    """
+    ids = [i.strip() for i in (request.args.get("ids") or "").split(",") if i.strip()]
+    if not ids:
+        return jsonify({"success": False, "error": "Missing ids"}), 400
+    ids = ids[:POLL_STREAM_MAX_IDS]
+
+    def generate():
+        # Iscrizione dentro il generatore: se la risposta non viene mai iterata
+        # (client già disconnesso) non resta nessuna sottoscrizione orfana
+        sub = event_hub.subscribe([f"poll:{i}" for i in ids])
+        try:
+            yield "retry: 3000\n\n"
+            deadline = time.monotonic() + SSE_MAX_STREAM_SECONDS
+            while time.monotonic() < deadline:
+                events = sub.get(timeout=SSE_KEEPALIVE_SECONDS)
+                if not events:
+                    yield sse_comment()
+                    continue
+                for ev in events:
+                    yield sse_event(ev["data"], event="tally", event_id=ev["id"])
+        finally:
+            sub.close()
+
+    return sse_response(generate())
 
 # ============= CHAT (Supabase) =============
 
+CHAT_COLUMNS = "id,thread_id,sender_id,sender_name,receiver_id,text,created_at"
+CHAT_PAGE_SIZE = 100
+CHAT_MAX_PAGE_SIZE = 500
+
+def pgrst_quote(value):
+    """Quota un valore per i filtri or=(...) di PostgREST (timestamp con ':' e '+')."""
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def fetch_thread_messages(thread_id, after=None, after_id=None, before=None, limit=CHAT_PAGE_SIZE):
+    """
+    Pagina di messaggi di un thread, sempre in ordine cronologico.
+    - after (+ afterId opzionale come spareggio): solo i messaggi successivi al cursore
+    - before: i 'limit' messaggi precedenti al cursore (scroll verso l'alto)
+    - nessun cursore: gli ultimi 'limit' messaggi
+    Ritorna (messages, has_more).
+    """
+    q = supabase.table("chat_messages").select(CHAT_COLUMNS).eq("thread_id", thread_id)
+
+    if after:
+        if after_id:
+            a = pgrst_quote(after)
+            q = q.or_(f"created_at.gt.{a},and(created_at.eq.{a},id.gt.{pgrst_quote(after_id)})")
+        else:
+            q = q.gt("created_at", after)
+        rows = q.order("created_at").order("id").limit(limit + 1).execute().data or []
+        return rows[:limit], len(rows) > limit
+
+    if before:
+        q = q.lt("created_at", before)
+    rows = q.order("created_at", desc=True).order("id", desc=True).limit(limit + 1).execute().data or []
+    return list(reversed(rows[:limit])), len(rows) > limit
+
 @app.route('/api/messages/thread/<thread_id>', methods=['GET'])
 def get_thread_messages(thread_id):
+    """
+    Query: ?after=<created_at>&afterId=<id> | ?before=<created_at>, &limit=100
+    Response: { "success": true, "data": [...], "cursor": { "after", "afterId", "before", "hasMore" } }
+    Con 'after' il polling di un thread senza novità ritorna una lista vuota.
+    """
     if not supabase:
         return jsonify({"success": False, "error": "Supabase not configured"}), 500
 
     try:
+        after = request.args.get("after")
+        after_id = request.args.get("afterId")
+        before = request.args.get("before")
+        limit, _ = parse_page_args(request.args, CHAT_PAGE_SIZE, CHAT_MAX_PAGE_SIZE)
+
+        messages, has_more = fetch_thread_messages(thread_id, after, after_id, before, limit)
+
+        last = messages[-1] if messages else {}
+        first = messages[0] if messages else {}
+        cursor = {
+            "after": last.get("created_at", after),
+            "afterId": last.get("id", after_id),
+            "before": first.get("created_at", before),
+            "hasMore": has_more,
+        }
+        return jsonify({"success": True, "data": messages, "cursor": cursor}), 200
+    except Exception as e:
+        debug_log("⚠️ get_thread_messages error", str(e))
+        return jsonify({"success": False, "error": str(e)}), 500
+
+CHAT_INBOX_COLUMNS = "thread_id,counterpart_id,counterpart_name,last_message,last_sender_id,last_message_at,unread_count"
+CHAT_INBOX_MAX_THREADS = 200
+
+def bump_chat_inbox(row, receiver_name=None):
+    """
+    Aggiorna l'inbox di mittente e destinatario (vedi CHAT_INBOX.sql). Non bloccante.
+    I nomi non forniti dal client vengono risolti da 'profiles' dentro la funzione.
+    """
+    try:
+        supabase.rpc("chat_inbox_bump", {
+            "p_thread_id": row.get("thread_id"),
+            "p_sender_id": row.get("sender_id"),
+            "p_sender_name": row.get("sender_name"),
+            "p_receiver_id": row.get("receiver_id"),
+            "p_text": row.get("text"),
+            "p_created_at": row.get("created_at") or datetime.now(timezone.utc).isoformat(),
+            "p_receiver_name": receiver_name,
+        }).execute()
+    except Exception as e:
+        debug_log("⚠️ chat_inbox_bump error (non-fatal)", str(e))
+
+@app.route('/api/messages/inbox/<user_id>', methods=['GET'])
+def get_inbox(user_id):
+    """
+    Lista delle conversazioni di un utente, dalla più recente.
+    Response: { "success": true, "data": [{ "threadId", "counterpartId", "counterpartName",
+                "lastMessage": { "text", "senderId", "createdAt" }, "unreadCount" }] }
+    """
+    if not supabase:
+        return jsonify({"success": False, "error": "Supabase not configured"}), 500
+
+    try:
+        limit, offset = parse_page_args(request.args, CHAT_INBOX_MAX_THREADS, CHAT_INBOX_MAX_THREADS)
         resp = (
-            supabase.table("chat_messages")
-            .select("*")
+            supabase.table("chat_inbox")
+            .select(CHAT_INBOX_COLUMNS)
+            .eq("user_id", user_id)
+            .order("last_message_at", desc=True)
+            .range(offset, offset + limit - 1)
+            .execute()
+        )
+        threads = [{
+            "threadId": r.get("thread_id"),
+            "counterpartId": r.get("counterpart_id"),
+            "counterpartName": r.get("counterpart_name"),
+            "lastMessage": {
+                "text": r.get("last_message"),
+                "senderId": r.get("last_sender_id"),
+                "createdAt": r.get("last_message_at"),
+            },
+            "unreadCount": r.get("unread_count") or 0,
+        } for r in (resp.data or [])]
+        return jsonify({"success": True, "data": threads}), 200
+    except Exception as e:
+        debug_log("⚠️ get_inbox error", str(e))
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/api/messages/inbox/<user_id>/read', methods=['POST'])
+def mark_thread_read(user_id):
+    """Azzera i non letti di un thread. Body: { "threadId": "..." }"""
+    if not supabase:
+        return jsonify({"success": False, "error": "Supabase not configured"}), 500
+
+    try:
+        thread_id = (request.json or {}).get("threadId")
+        if not thread_id:
+            return jsonify({"success": False, "error": "Missing threadId"}), 400
+        (
+            supabase.table("chat_inbox")
+            .update({"unread_count": 0})
+            .eq("user_id", user_id)
             .eq("thread_id", thread_id)
-            .order("created_at", desc=False)
-            .limit(500)
             .execute()
         )
-        return jsonify({"success": True, "data": resp.data or []}), 200
+        return jsonify({"success": True}), 200
     except Exception as e:
-        debug_log("⚠️ get_thread_messages error", str(e))
+        debug_log("⚠️ mark_thread_read error", str(e))
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/api/messages', methods=['POST'])
 def post_message():
+    """Inserisce un messaggio e restituisce solo la riga creata."""
     if not supabase:
         return jsonify({"success": False, "error": "Supabase not configured"}), 500
 
@@ -1223,23 +1850,90 @@ def post_message():
             "text": msg["text"],
         }
 
-        supabase.table("chat_messages").insert(payload).execute()
-
-        # return updated thread
-        resp = (
-            supabase.table("chat_messages")
-            .select("*")
-            .eq("thread_id", msg["threadId"])
-            .order("created_at", desc=False)
-            .limit(500)
-            .execute()
-        )
-        return jsonify({"success": True, "data": resp.data or []}), 200
+        resp = supabase.table("chat_messages").insert(payload).execute()
+        row = (resp.data or [payload])[0]
+        bump_chat_inbox(row, msg.get("receiverName"))
+        event_hub.publish(f"chat:{msg['threadId']}", row)
+        return jsonify({"success": True, "data": row}), 200
 
     except Exception as e:
         debug_log("⚠️ post_message error", str(e))
         return jsonify({"success": False, "error": str(e)}), 500
 
+CHAT_STREAM_RESYNC_SECONDS = 30  # rete di sicurezza se un evento non arriva (altro host, bridge assente)
+
+def parse_chat_cursor(value):
+    """Cursore SSE 'created_at|id' (Last-Event-ID) -> (created_at, id)."""
+    if not value:
+        return None, None
+    created_at, _, msg_id = str(value).rpartition("|")
+    if not created_at:
+        return msg_id or None, None
+    return created_at, msg_id or None
+
+@app.route('/api/messages/thread/<thread_id>/stream', methods=['GET'])
+def stream_thread_messages(thread_id):
+    """
+    Stream SSE dei nuovi messaggi di un thread (sostituisce il polling).
+    Query: ?after=<created_at>&afterId=<id>, oppure header Last-Event-ID per riprendere
+    dall'ultimo messaggio visto: i messaggi persi vengono inviati prima di quelli live.
+    Evento 'message': la riga di chat_messages. L'id SSE è 'created_at|id'.
+    """
+    if not supabase:
+        return jsonify({"success": False, "error": "Supabase not configured"}), 500
+
+    after, after_id = parse_chat_cursor(request.headers.get("Last-Event-ID"))
+    if not after:
+        after = request.args.get("after")
+        after_id = request.args.get("afterId")
+
+    def generate():
+        cursor = {"after": after, "afterId": after_id}
+        sent = deque(maxlen=500)  # id già inviati: catch-up e live possono sovrapporsi
+
+        def emit(rows):
+            for row in rows:
+                if row.get("id") in sent:
+                    continue
+                sent.append(row.get("id"))
+                cursor["after"], cursor["afterId"] = row.get("created_at"), row.get("id")
+                yield sse_event(row, event="message", event_id=f"{row.get('created_at')}|{row.get('id')}")
+
+        def catch_up():
+            if not cursor["after"]:
+                return []
+            rows, _ = fetch_thread_messages(thread_id, cursor["after"], cursor["afterId"],
+                                            limit=CHAT_MAX_PAGE_SIZE)
+            return rows
+
+        # Iscrizione PRIMA del recupero (nessun messaggio cade tra catch-up e live)
+        # e dentro il generatore, così il finally la chiude sempre
+        sub = event_hub.subscribe([f"chat:{thread_id}"])
+        try:
+            yield "retry: 3000\n\n"
+            yield from emit(catch_up())
+            deadline = time.monotonic() + SSE_MAX_STREAM_SECONDS
+            next_resync = time.monotonic() + CHAT_STREAM_RESYNC_SECONDS
+            dropped = 0
+            while time.monotonic() < deadline:
+                events = sub.get(timeout=SSE_KEEPALIVE_SECONDS)
+                if sub.dropped != dropped or time.monotonic() >= next_resync:
+                    # Client lento (eventi scartati) o resync periodico: recupera dal cursore
+                    dropped = sub.dropped
+                    next_resync = time.monotonic() + CHAT_STREAM_RESYNC_SECONDS
+                    try:
+                        yield from emit(catch_up())
+                    except Exception as e:
+                        debug_log("⚠️ chat stream resync error", str(e))
+                if events:
+                    yield from emit(ev["data"] for ev in events)
+                else:
+                    yield sse_comment()
+        finally:
+            sub.close()
+
+    return sse_response(generate())
+
 @app.route('/api/resolve-profile', methods=['POST'])
 def resolve_profile():
     """
@@ -1282,6 +1976,18 @@ def resolve_profile():
         debug_log("⚠️ resolve_profile error", str(e))
         return jsonify({"success": False, "error": str(e)}), 500
 
+# ============= SERVER-TIMING =============
+# Tempi per fase (login OAuth, estrazione dati) nell'header Server-Timing di /login e /sync:
+# su richiesta con 'X-Debug-Timing: 1' o ?timing=1, sempre con SERVER_TIMING=true.
+# Le stesse fasi finiscono comunque nelle metriche di /health?verbose=1.
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "false").lower() == "true"
+DATA_METRIC_PREFIX = "argo-data"
+
+def with_server_timing(response, timer):
+    if SERVER_TIMING or request.headers.get("X-Debug-Timing") == "1" or request.args.get("timing") == "1":
+        response.headers["Server-Timing"] = timer.header()
+    return response
+
 @app.route('/login', methods=['POST'])
 def login():
     """
@@ -1297,6 +2003,7 @@ def login():
     if not all([school, username, password]):
         return jsonify({"success": False, "error": "Dati mancanti"}), 400
 
+    timer = StageTimer()
     try:
         debug_log("LOGIN REQUEST", {
             "school": school,
@@ -1305,7 +2012,7 @@ def login():
         })
 
         # 1) Login con profili minimi
-        login_result = AdvancedArgo.raw_login(school, username, password)
+        login_result = AdvancedArgo.raw_login(school, username, password, timer)
         access_token = login_result['access_token']
         profiles = login_result.get('profiles', []) or []
 
@@ -1342,9 +2049,10 @@ def login():
         # 3) Identità finale (completa solo se manca)
         student_name = (target_profile.get('name') or '').strip().upper()
         student_class = (target_profile.get('class') or '').strip().upper()
-        student_name, student_class = resolve_identity_for_profile(
-            school, username, password, access_token, auth_token, student_name, student_class
-        )
+        with timer.stage("identity", DATA_METRIC_PREFIX):
+            student_name, student_class = resolve_identity_for_profile(
+                school, username, password, access_token, auth_token, student_name, student_class
+            )
 
         # Fallback ultimissimo
         if not student_name:
@@ -1354,30 +2062,39 @@ def login():
 
         # 4) Dati scolastici
         session = create_session(school, username, password, access_token, auth_token)
-        grades_data = extract_grades_multi_strategy(session)
+        scope = class_scope(school, student_class)
+        failed = []
+        grades_data = []
+        try:
+            with timer.stage("grades", DATA_METRIC_PREFIX):
+                grades_data = extract_grades_multi_strategy(session)
+        except Exception:
+            failed.append("voti")
         tasks_data = []
         try:
-            tasks_data = extract_homework_safe(session)
+            with timer.stage("homework", DATA_METRIC_PREFIX):
+                tasks_data = extract_homework_safe(session, scope)
         except Exception:
-            pass
+            failed.append("tasks")
         announcements_data = []
         try:
-            dash = session.dashboard()
-            announcements_data = extract_promemoria(dash)
+            with timer.stage("dashboard", DATA_METRIC_PREFIX):
+                dash = session.dashboard()
+                announcements_data = extract_promemoria(dash, scope)
         except Exception:
-            pass
+            failed.append("promemoria")
+
+        # Snapshot del profilo (base per /sync con knownHash)
+        extracted = {"voti": grades_data, "tasks": tasks_data, "promemoria": announcements_data}
+        snapshot_info = save_snapshot(f"{school}:{username}:{target_index}", extracted, failed)
+        grades_data, tasks_data, announcements_data = extracted["voti"], extracted["tasks"], extracted["promemoria"]
 
         # 5) Upsert su Supabase
         if supabase:
             try:
                 pid = f"{school}:{username}:{target_index}"
-                supabase.table("profiles").upsert({
-                    "id": pid,
-                    "name": student_name,
-                    "class": student_class,
-                    "last_active": datetime.now().isoformat()
-                }, on_conflict="id").execute()
-                debug_log("👤 Profile upsert", {"id": pid, "name": student_name, "class": student_class})
+                written = touch_profile(pid, student_name, student_class)
+                debug_log("👤 Profile upsert", {"id": pid, "name": student_name, "class": student_class, "sync": written})
             except Exception as e:
                 debug_log("⚠️ Supabase upsert error (non-fatal)", str(e))
 
@@ -1394,7 +2111,9 @@ def login():
             "student": {"name": student_name, "class": student_class, "school": school},
             "tasks": tasks_data,
             "voti": grades_data,
-            "promemoria": announcements_data
+            "promemoria": announcements_data,
+            "stats": grade_stats(grades_data),
+            **snapshot_info
         }
 
         # selectedProfile senza campi sensibili
@@ -1421,17 +2140,17 @@ def login():
             "student_class": student_class,
             "profiles_count": len(profiles)
         })
-        return jsonify(resp), 200
+        return with_server_timing(jsonify(negotiate_payload(resp)), timer), 200
 
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
         debug_log("❌ LOGIN FAILED", error_trace)
-        return jsonify({
+        return with_server_timing(jsonify({
             "success": False,
             "error": str(e),
             "traceback": error_trace if DEBUG_MODE else None
-        }), 401
+        }), timer), 401
 
 @app.route('/test/profile-structure', methods=['POST'])
 def test_profile_structure():
@@ -1483,6 +2202,179 @@ def test_profile_structure():
         })
         return jsonify(result), 500
 
+# ============= SYNC =============
+
+# /sync/batch: profili sincronizzati in parallelo (tetto ai thread per richiesta)
+SYNC_BATCH_WORKERS = int(os.environ.get("SYNC_BATCH_WORKERS", "4"))
+SYNC_BATCH_MAX_PROFILES = 10
+
+# Ultimo dataset estratto per profilo ('school:user:index'), compresso su disco:
+# base per check "è cambiato?" (knownHash) e fallback quando Argo non risponde
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "gconnect-snapshots"))
+snapshot_store = SnapshotStore(SNAPSHOT_DIR)
+SNAPSHOT_SECTIONS = ("voti", "tasks", "promemoria")
+
+
+def decode_cred(encoded):
+    """Credenziali salvate dal client: base64 di una stringa URL-encoded (o in chiaro)."""
+    try:
+        return unquote(base64.b64decode(encoded).decode('utf-8'))
+    except Exception:
+        return encoded
+
+
+def sync_login(school, user, pwd, timer=None):
+    """
+    Login unico per /sync e /sync/batch.
+    Ritorna (access_token, profiles, fallback_auth_token): con il login avanzato
+    ogni profilo ha il suo token; col fallback standard c'è solo il token del profilo 0.
+    """
+    try:
+        login_result = AdvancedArgo.raw_login(school, user, pwd, timer)
+        return login_result['access_token'], login_result.get('profiles', []) or [], None
+    except Exception as e:
+        debug_log("⚠️ Sync Advanced Fail -> Fallback Standard", str(e))
+        tmp = argofamiglia.ArgoFamiglia(school, user, pwd)
+        headers = tmp._ArgoFamiglia__headers
+        access_token = headers.get('Authorization', '').replace('Bearer ', '')
+        return access_token, [], headers.get('x-auth-token', '')
+
+
+def save_snapshot(pid, result, failed=()):
+    """
+    Salva il dataset estratto nello snapshot del profilo e ritorna i campi da
+    aggiungere alla risposta ('snapshot' e, se servono dati vecchi, 'stale').
+    Le sezioni fallite non sovrascrivono lo snapshot: sono completate con i
+    dati dell'ultimo snapshot valido, mentre quelle riuscite vengono salvate.
+    """
+    token = calendar_token(pid)
+    extra = {"calendarPath": f"/api/calendar/{token}.ics"} if token else {}
+    try:
+        if failed:
+            snap = snapshot_store.get(pid)
+            if not snap:
+                # Nessun dato precedente: meglio non salvare sezioni vuote come valide
+                return {"stale": list(failed), **extra}
+            for section in failed:
+                result[section] = snap["data"].get(section, [])
+        meta, changed = snapshot_store.put(pid, {k: result[k] for k in SNAPSHOT_SECTIONS})
+        if token and "tasks" not in failed:
+            # Compiti per il feed .ics, letti per token senza login ad Argo
+            snapshot_store.put(f"ics:{token}", {"tasks": result["tasks"]})
+        info = {"snapshot": {**meta, "changed": changed}, **extra}
+        if failed:
+            info["stale"] = list(failed)
+        return info
+    except Exception as e:
+        debug_log("⚠️ Snapshot error (non-fatal)", str(e))
+        return {}
+
+
+def sync_profile(school, user, pwd, access_token, auth_token, profile_index, profile=None, timer=None):
+    """
+    Voti, compiti e promemoria di un profilo, con errori isolati per sezione.
+    Le sezioni fallite sono servite dall'ultimo snapshot (elencate in 'stale').
+    Aggiorna anche last_active (e identità se recuperabile) su Supabase.
+    """
+    timer = timer or StageTimer()
+    pid = f"{school}:{user}:{profile_index}"
+    scope = class_scope(school, (profile or {}).get('class'))
+    grades = []
+    tasks = []
+    promemoria = []
+    failed = []
+
+    # Sessioni isolate per estrazione dati
+    try:
+        with timer.stage("grades", DATA_METRIC_PREFIX):
+            argo_voti = create_session(school, user, pwd, access_token, auth_token)
+            grades = extract_grades_multi_strategy(argo_voti)
+    except Exception as e:
+        failed.append("voti")
+        debug_log("⚠️ Sync voti error", str(e))
+
+    try:
+        with timer.stage("homework", DATA_METRIC_PREFIX):
+            argo_tasks = create_session(school, user, pwd, access_token, auth_token)
+            tasks = extract_homework_safe(argo_tasks, scope)
+    except Exception as e:
+        failed.append("tasks")
+        debug_log("⚠️ Sync compiti error", str(e))
+
+    try:
+        with timer.stage("dashboard", DATA_METRIC_PREFIX):
+            argo_dash = create_session(school, user, pwd, access_token, auth_token)
+            dash = argo_dash.dashboard()
+            promemoria = extract_promemoria(dash, scope)
+    except Exception as e:
+        failed.append("promemoria")
+        debug_log("⚠️ Sync dashboard error", str(e))
+
+    result = {"tasks": tasks, "voti": grades, "promemoria": promemoria}
+    result.update(save_snapshot(pid, result, failed))
+    # Medie e andamento per materia (in cache finché i voti non cambiano)
+    result["stats"] = grade_stats(result["voti"])
+
+    if supabase:
+        try:
+            s_name = None
+            s_class = None
+            if profile:
+                # opzionale: prova a risolvere identità per il profilo selezionato
+                with timer.stage("identity", DATA_METRIC_PREFIX):
+                    s_name, s_class = resolve_identity_for_profile(
+                        school, user, pwd, access_token, auth_token,
+                        profile.get('name'), profile.get('class')
+                    )
+            if not (s_class and CLASS_REGEX.match(s_class)):
+                s_class = None
+            written = touch_profile(pid, s_name, s_class)
+            debug_log("👤 Profile sync upsert", {"id": pid, "name": s_name, "class": s_class, "sync": written})
+        except Exception as e:
+            debug_log("⚠️ Profile sync supabase error", str(e))
+
+    return result
+
+
+@app.route('/api/calendar/<token>.ics', methods=['GET'])
+def homework_calendar(token):
+    """
+    Feed iCalendar dei compiti (URL da 'calendarPath' di /login e /sync).
+    Servito dallo snapshot: nessuna chiamata ad Argo, 304 con If-None-Match / If-Modified-Since.
+    """
+    if not is_valid_token(token):
+        return jsonify({"success": False, "error": "Calendario non trovato"}), 404
+    key = f"ics:{token}"
+    meta = snapshot_store.meta(key)
+    if not meta:
+        return jsonify({"success": False, "error": "Calendario non trovato"}), 404
+
+    etag = meta["hash"]
+    changed_at = None
+    try:
+        changed_at = datetime.fromisoformat(meta.get("changedAt") or meta["fetchedAt"])
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    response = Response(status=304)
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        since = request.if_modified_since
+        not_modified = bool(since and changed_at and changed_at.replace(microsecond=0) <= since)
+    if not not_modified:
+        snap = snapshot_store.get(key)
+        if not snap:
+            return jsonify({"success": False, "error": "Calendario non trovato"}), 404
+        response = Response(cached_ics(etag, snap["data"].get("tasks"), changed_at),
+                            mimetype="text/calendar")
+        response.headers["Content-Disposition"] = 'inline; filename="compiti.ics"'
+    response.set_etag(etag)
+    if changed_at:
+        response.last_modified = changed_at
+    response.headers["Cache-Control"] = "private, max-age=900"
+    return response
+
 @app.route('/sync', methods=['POST', 'OPTIONS'])
 def sync_data():
     # Preflight CORS
@@ -1495,101 +2387,142 @@ def sync_data():
     stored_pass = data.get('storedPass')
     profile_index = int(data.get('profileIndex', 0))
 
+    timer = StageTimer()
     try:
         debug_log("SYNC REQUEST", {"school": school, "profileIndex": profile_index})
 
         if not all([school, stored_user, stored_pass]):
             return jsonify({"success": False, "error": "Credenziali mancanti"}), 401
 
-        # Decodifica credenziali
-        import base64, urllib.parse
-        def decode_cred(encoded):
-            try:
-                return urllib.parse.unquote(base64.b64decode(encoded).decode('utf-8'))
-            except:
-                return encoded
         user = decode_cred(stored_user).strip().lower()
         pwd  = decode_cred(stored_pass)
 
         # Login avanzato (profili minimi)
-        access_token = None
-        auth_token = None
-        profiles = []
-        try:
-            login_result = AdvancedArgo.raw_login(school, user, pwd)
-            access_token = login_result['access_token']
-            profiles = login_result.get('profiles', []) or []
-            if profiles:
-                if profile_index < 0 or profile_index >= len(profiles):
-                    profile_index = 0
-                auth_token = profiles[profile_index].get('token', '')
-        except Exception as e:
-            debug_log("⚠️ Sync Advanced Fail -> Fallback Standard", str(e))
-            tmp = argofamiglia.ArgoFamiglia(school, user, pwd)
-            headers = tmp._ArgoFamiglia__headers
-            auth_token = headers.get('x-auth-token', '')
-            access_token = headers.get('Authorization', '').replace('Bearer ', '')
-
-        # Sessioni isolate per estrazione dati
-        grades = []
-        tasks = []
-        promemoria = []
-
-        try:
-            argo_voti = create_session(school, user, pwd, access_token, auth_token)
-            grades = extract_grades_multi_strategy(argo_voti)
-        except Exception as e:
-            debug_log("⚠️ Sync voti error", str(e))
-
-        try:
-            argo_tasks = create_session(school, user, pwd, access_token, auth_token)
-            tasks = extract_homework_safe(argo_tasks)
-        except Exception as e:
-            debug_log("⚠️ Sync compiti error", str(e))
+        access_token, profiles, auth_token = sync_login(school, user, pwd, timer)
+        profile = None
+        if profiles:
+            if profile_index < 0 or profile_index >= len(profiles):
+                profile_index = 0
+            profile = profiles[profile_index]
+            auth_token = profile.get('token', '')
 
-        try:
-            argo_dash = create_session(school, user, pwd, access_token, auth_token)
-            dash = argo_dash.dashboard()
-            promemoria = extract_promemoria(dash)
-        except Exception as e:
-            debug_log("⚠️ Sync dashboard error", str(e))
+        result = sync_profile(school, user, pwd, access_token, auth_token, profile_index, profile, timer)
 
-        # Aggiorna Supabase last_active (e identità se recuperabile)
-        if supabase:
-            try:
-                s_name = None
-                s_class = None
-                if profiles and 0 <= profile_index < len(profiles):
-                    # opzionale: prova a risolvere identità per il profilo selezionato
-                    s_name, s_class = resolve_identity_for_profile(
-                        school, user, pwd, access_token, auth_token,
-                        profiles[profile_index].get('name'), profiles[profile_index].get('class')
-                    )
-                pid = f"{school}:{user}:{profile_index}"
-                update_payload = {"last_active": datetime.now().isoformat()}
-                if s_name: update_payload["name"] = s_name
-                if s_class and CLASS_REGEX.match(s_class): update_payload["class"] = s_class
-                supabase.table("profiles").upsert({"id": pid, **update_payload}, on_conflict="id").execute()
-                debug_log("👤 Profile sync upsert", {"id": pid, **update_payload})
-            except Exception as e:
-                debug_log("⚠️ Profile sync supabase error", str(e))
+        # Il client ha già questa versione: niente dati nella risposta
+        known_hash = data.get('knownHash')
+        if known_hash and (result.get("snapshot") or {}).get("hash") == known_hash:
+            for section in SNAPSHOT_SECTIONS + ("stats",):
+                result.pop(section, None)
+            result["unchanged"] = True
 
-        return jsonify({
+        return with_server_timing(jsonify(negotiate_payload({
             "success": True,
-            "tasks": tasks,
-            "voti": grades,
-            "promemoria": promemoria,
+            **result,
             "new_tokens": {
                 "authToken": auth_token,
                 "accessToken": access_token
             }
-        }), 200
+        })), timer), 200
 
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
         debug_log("❌ SYNC FAILED", error_trace)
-        return jsonify({"success": False, "error": str(e), "traceback": error_trace if DEBUG_MODE else None}), 401
+        return with_server_timing(jsonify({"success": False, "error": str(e), "traceback": error_trace if DEBUG_MODE else None}), timer), 401
+
+@app.route('/sync/batch', methods=['POST', 'OPTIONS'])
+def sync_batch():
+    """
+    Sync di più profili dello stesso account (famiglie con più figli, refresh schedulati).
+    Body: { "schoolCode": "...", "storedUser": "...", "storedPass": "...", "profileIndexes": [0, 1] }
+    Senza profileIndexes sincronizza tutti i profili. Un solo login Argo, profili
+    scaricati in parallelo; l'errore di un profilo non blocca gli altri.
+    """
+    if request.method == 'OPTIONS':
+        return ('', 204)
+
+    data = request.json or {}
+    school = (data.get('schoolCode') or '').strip().upper()
+    stored_user = data.get('storedUser')
+    stored_pass = data.get('storedPass')
+    indexes = data.get('profileIndexes')
+
+    if not all([school, stored_user, stored_pass]):
+        return jsonify({"success": False, "error": "Credenziali mancanti"}), 401
+    if indexes is not None:
+        try:
+            if not isinstance(indexes, list):
+                raise TypeError
+            indexes = list(dict.fromkeys(int(i) for i in indexes))
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "profileIndexes deve essere una lista di interi"}), 400
+        if len(indexes) > SYNC_BATCH_MAX_PROFILES:
+            return jsonify({"success": False, "error": f"Massimo {SYNC_BATCH_MAX_PROFILES} profili per richiesta"}), 400
+
+    timer = StageTimer()
+    try:
+        user = decode_cred(stored_user).strip().lower()
+        pwd  = decode_cred(stored_pass)
+
+        # Un solo login per tutti i profili
+        access_token, profiles, fallback_token = sync_login(school, user, pwd, timer)
+        if indexes is None:
+            indexes = list(range(len(profiles) or 1))[:SYNC_BATCH_MAX_PROFILES]
+        debug_log("SYNC BATCH REQUEST", {"school": school, "profileIndexes": indexes, "profiles": len(profiles)})
+
+        def run(idx):
+            if profiles:
+                if not 0 <= idx < len(profiles):
+                    return {"profileIndex": idx, "success": False, "error": "Profilo non trovato"}
+                profile = profiles[idx]
+                auth_token = profile.get('token', '')
+            elif idx == 0:
+                profile, auth_token = None, fallback_token
+            else:
+                return {"profileIndex": idx, "success": False, "error": "Profilo non disponibile"}
+            # Timer per profilo (i profili girano in parallelo), riportato nel timer
+            # della richiesta come 'p<indice>-<fase>'
+            profile_timer = StageTimer()
+            try:
+                result = sync_profile(school, user, pwd, access_token, auth_token, idx, profile, profile_timer)
+                return {"profileIndex": idx, "success": True, **result, "authToken": auth_token}
+            except Exception as e:
+                debug_log("⚠️ Sync batch profile error", {"idx": idx, "error": str(e)})
+                return {"profileIndex": idx, "success": False, "error": str(e)}
+            finally:
+                for name, ms in profile_timer.stages:
+                    timer.add(f"p{idx}-{name}", ms)
+
+        workers = max(1, min(SYNC_BATCH_WORKERS, len(indexes)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run, indexes))
+
+        return with_server_timing(jsonify(negotiate_payload({
+            "success": any(r["success"] for r in results),
+            "profiles": results,
+            "new_tokens": {"accessToken": access_token}
+        })), timer), 200
+
+    except Exception as e:
+        import traceback
+        error_trace = traceback.format_exc()
+        debug_log("❌ SYNC BATCH FAILED", error_trace)
+        return with_server_timing(jsonify({"success": False, "error": str(e), "traceback": error_trace if DEBUG_MODE else None}), timer), 401
+
+# ============= AVVIO =============
+
+def warm_up():
+    """Crea in anticipo ciò che altrimenti pagherebbe la prima richiesta (client supabase)."""
+    start = time.perf_counter()
+    bool(supabase)
+    debug_log("🔥 Warm-up completato", {"seconds": round(time.perf_counter() - start, 3)})
+
+STARTUP_SECONDS = round(time.perf_counter() - _import_started, 3)
+
+# WARMUP_ON_START=true: warm-up in background subito dopo l'import (in ogni worker),
+# senza ritardare la prima risposta
+if os.environ.get("WARMUP_ON_START", "false").lower() == "true":
+    threading.Thread(target=warm_up, daemon=True, name="warm-up").start()
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,120 @@
+import os
+import json
+import zlib
+import tempfile
+import threading
+from hashlib import sha256
+from datetime import datetime, timezone
+
+from cache import TTLCache
+
+# Campi generati a ogni estrazione (id casuali): esclusi dall'hash del contenuto
+VOLATILE_KEYS = frozenset({"id"})
+
+
+def content_hash(data):
+    """Hash stabile del contenuto: JSON canonico (chiavi ordinate), senza i campi volatili."""
+    def strip(obj):
+        if isinstance(obj, dict):
+            return {k: strip(v) for k, v in obj.items() if k not in VOLATILE_KEYS}
+        if isinstance(obj, list):
+            return [strip(v) for v in obj]
+        return obj
+    canonical = json.dumps(strip(data), sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+class SnapshotStore:
+    """
+    Ultimo dataset estratto da Argo per profilo ('school:user:index'), su disco.
+    Per ogni chiave due file:
+      - <h>.meta.json  versione, data di fetch/ultima modifica e hash (check veloci)
+      - <h>.json.z     dati completi compressi con zlib
+    La versione aumenta solo quando cambia l'hash del contenuto.
+    I metadati restano anche in memoria (per meta_ttl secondi, così un worker
+    vede presto le scritture degli altri), quindi has_changed() di norma non tocca il disco.
+    """
+    def __init__(self, directory, meta_cache_size=5000, meta_ttl=30, level=6):
+        self.directory = directory
+        self.level = level
+        self._meta = TTLCache(maxsize=meta_cache_size, ttl=meta_ttl)
+        self._lock = threading.Lock()
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _path(self, key, suffix):
+        # nome file derivato dalla chiave: niente username in chiaro sul filesystem
+        return os.path.join(self.directory, sha256(key.encode("utf-8")).hexdigest()[:40] + suffix)
+
+    def _write_atomic(self, path, payload):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(payload)
+            os.replace(tmp, path)
+        except Exception:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def meta(self, key):
+        """{'version', 'fetchedAt', 'changedAt', 'hash'} o None se non c'è snapshot."""
+        meta = self._meta.get(key)
+        if meta is not None:
+            return meta
+        try:
+            with open(self._path(key, ".meta.json"), "rb") as f:
+                meta = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        self._meta.set(key, meta)
+        return meta
+
+    def has_changed(self, key, known_hash):
+        meta = self.meta(key)
+        return meta is None or meta.get("hash") != known_hash
+
+    def get(self, key):
+        """Snapshot completo {'version', 'fetchedAt', 'hash', 'data'} o None."""
+        meta = self.meta(key)
+        if meta is None:
+            return None
+        try:
+            with open(self._path(key, ".json.z"), "rb") as f:
+                data = json.loads(zlib.decompress(f.read()))
+        except (OSError, ValueError, zlib.error):
+            return None
+        return {**meta, "data": data}
+
+    def put(self, key, data):
+        """
+        Salva il dataset. Ritorna (meta, changed): se il contenuto è invariato
+        si aggiorna solo fetchedAt, senza riscrivere i dati.
+        """
+        digest = content_hash(data)
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            previous = self.meta(key)
+            changed = previous is None or previous.get("hash") != digest
+            meta = {
+                "version": (previous or {}).get("version", 0) + (1 if changed else 0),
+                "fetchedAt": now,
+                "changedAt": now if changed else (previous.get("changedAt") or previous.get("fetchedAt")),
+                "hash": digest,
+            }
+            if changed:
+                raw = json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+                self._write_atomic(self._path(key, ".json.z"), zlib.compress(raw, self.level))
+            self._write_atomic(self._path(key, ".meta.json"), json.dumps(meta).encode("utf-8"))
+            self._meta.set(key, meta)
+        return meta, changed
+
+    def delete(self, key):
+        with self._lock:
+            self._meta.pop(key)
+            for suffix in (".meta.json", ".json.z"):
+                try:
+                    os.unlink(self._path(key, suffix))
+                except OSError:
+                    pass
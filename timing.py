@@ -0,0 +1,43 @@
+import time
+import threading
+from contextlib import contextmanager
+
+import db
+
+
+class StageTimer:
+    """
+    Tempi per fase di una richiesta (es. le fasi del login OAuth Argo).
+    Ogni fase è registrata anche nelle metriche di db.stats() come
+    '<metric_prefix>:<fase>', e può essere esposta nell'header Server-Timing.
+    """
+    def __init__(self, metric_prefix=None):
+        self.metric_prefix = metric_prefix
+        self.stages = []  # [(nome, ms)]
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, metric_prefix=None):
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000, ok, metric_prefix)
+
+    def add(self, name, elapsed_ms, ok=True, metric_prefix=None):
+        with self._lock:
+            self.stages.append((name, elapsed_ms))
+        prefix = metric_prefix or self.metric_prefix
+        if prefix:
+            db.record(f"{prefix}:{name}", elapsed_ms, ok)
+
+    def as_dict(self):
+        with self._lock:
+            return {name: round(ms, 1) for name, ms in self.stages}
+
+    def header(self):
+        """Valore per 'Server-Timing': 'challenge;dur=120.4, sso;dur=300.2, ...'."""
+        with self._lock:
+            return ", ".join(f"{name};dur={ms:.1f}" for name, ms in self.stages)
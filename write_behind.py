@@ -0,0 +1,77 @@
+import atexit
+import threading
+
+
+class WriteBehindBuffer:
+    """
+    Buffer write-behind: accumula gli aggiornamenti per chiave (l'ultimo vince,
+    campo per campo) e li scrive in blocco con flush_fn(rows).
+    Il flush avviene ogni 'interval' secondi, quando si superano 'max_pending'
+    chiavi in attesa, oppure alla chiusura del processo.
+    """
+    def __init__(self, flush_fn, interval=10.0, max_pending=200, on_error=None):
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self.max_pending = max_pending
+        self.on_error = on_error
+        self._pending = {}  # key -> dict
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._started = False
+        atexit.register(self.flush)
+
+    def put(self, key, row):
+        with self._lock:
+            self._pending.setdefault(key, {}).update(row)
+            full = len(self._pending) >= self.max_pending
+        self._ensure_started()
+        if full:
+            self._wakeup.set()
+
+    def discard(self, key):
+        """Scarta l'aggiornamento in attesa per 'key' (es. superato da una scrittura sincrona)."""
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Scrive tutto ciò che è in attesa. Ritorna il numero di righe inviate."""
+        with self._flush_lock:
+            with self._lock:
+                rows = list(self._pending.values())
+                batch = self._pending
+                self._pending = {}
+            if not rows:
+                return 0
+            try:
+                self.flush_fn(rows)
+                return len(rows)
+            except Exception as e:
+                # Rimette in coda senza sovrascrivere aggiornamenti più recenti
+                with self._lock:
+                    for key, row in batch.items():
+                        if key not in self._pending and len(self._pending) < self.max_pending * 10:
+                            self._pending[key] = row
+                if self.on_error:
+                    self.on_error(e)
+                return 0
+
+    def _ensure_started(self):
+        # Thread avviato al primo put: non sopravvive al fork dei worker gunicorn
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, daemon=True, name="write-behind").start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()